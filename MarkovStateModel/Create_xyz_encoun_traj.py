@@ -3,65 +3,31 @@ from tqdm import tqdm
 import numpy as np
 import sys
 import os
-import shutil
+import argparse
 import warnings
 warnings.filterwarnings("ignore")
-
-def create_pdb_from_coordinates(coordinates, output_file):
-    """
-    Create a PDB file from a list of coordinates.
-    
-    Parameters:
-    - coordinates: A list of tuples, where each tuple contains the (x, y, z) positions of an atom.
-    - output_file: The name of the output PDB file.
-    """
-    
-    with open(output_file, 'w') as pdb_file:
-        for i, (x, y, z) in enumerate(coordinates, start=1):
-            # Construct each PDB line according to the format
-            pdb_line = (
-                f"ATOM  {i:5d} CL   BEN A{i:4d}    "
-                f"{x:8.3f}{y:8.3f}{z:8.3f}  1.00  0.00          CL  \n"
-            )
-            pdb_file.write(pdb_line)
-            
-
-def printUsage():
-
-    print ("""
-    NAME
-        Create_xyz_encoun_traj.py
-
-    DESCRIPTION
-
-        Python script to write xyz file from extacted trajectory from Get_encounter_traj.py script
-
-    ARGUMENTS
-
-        It takes 3 parameters:
-        1.)     Name of sda input file
-        2.)     File/path of the p1_noh.pdb
-        3.)     File/path of the p1_noh.pdb
-        
-
-    EXAMPLE
-
-        python  Create_xyz_encoun_traj.py sda.in ../data_grid/p1_noh.pdb ../data_grid/p2_noh.pdb
-
-    OUTPUT
-
-        Output files with xyz coordinates of the solute 2 in the reference system of the p1 com are generated in folder_ftrajectories_xyz
-        Output pdb files with xyz coordinates of the solute 2 in the reference system of the p1 com are generated in folder_ftrajectories_vmd: fast way to visualize trajs in vmd
-
-    """)
-
-
-
-if "-h" in sys.argv:
-    print(printUsage())
-    sys.exit()
-
-with open(sys.argv[1], "r") as fin:
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tools"))
+from sda_trajectory import read_trajectory, parse_lines, open_file, resolve_path, strip_compression, compressed_name
+from sda_encounter import encounter_folder, ligand_positions, xyz_lines
+from segment_store import store_path, remove_output, write_store, load_store
+from vmd_output import write_vmd_trajectory, write_points_pdb, remove_vmd_output, VMD_FORMATS
+
+parser = argparse.ArgumentParser(description = "Python script to write xyz file from extacted trajectory from Get_encounter_traj.py script. "
+                                 "Output files with xyz coordinates of the solute 2 in the reference system of the p1 com are generated in folder_ftrajectories_xyz. "
+                                 "Output pdb files with xyz coordinates of the solute 2 in the reference system of the p1 com are generated in folder_ftrajectories_vmd: fast way to visualize trajs in vmd",
+                                 epilog="Example usage:\n"
+                                 "python  Create_xyz_encoun_traj.py sda.in ../data_grid/p1_noh.pdb ../data_grid/p2_noh.pdb")
+parser.add_argument("sda_input_file", help = "Name of sda input file", type=str)
+parser.add_argument("p1_noh", help = "File/path of the p1_noh.pdb", type=str)
+parser.add_argument("p2_noh", help = "File/path of the p2_noh.pdb", type=str)
+parser.add_argument("--compress", help = "If provided, compress the output xyz files (gz, bz2 or xz)", type=str, required = False, default=None, choices=["gz", "bz2", "xz"])
+parser.add_argument("--vmd_format", help = "Format of the files to visualize the trajectories in vmd: one pdb per trajectory (default), or a single dcd/xtc trajectory "
+                    "with all of them (folder_ftrajectories_vmd.pdb + .dcd/.xtc, also with the store)", type=str, required = False, default="pdb", choices=VMD_FORMATS)
+parser.add_argument("--full_atom", help = "If set, also write the positions of all the atoms of solute 2 in the reference system of the p1 com (xyz format, one file per trajectory in folder_ftrajectories_atoms)", action="store_true")
+parser.add_argument("--cut", help = "If Get_encounter_traj.py was run with several cutoffs, the cutoff of the encounter trajectories to use", type=float, required = False, default=None)
+argument = parser.parse_args()
+
+with open(argument.sda_input_file, "r") as fin:
     lines_sda_input=fin.readlines()
 for line in lines_sda_input:
     if "xmin" in line:
@@ -70,111 +36,86 @@ for line in lines_sda_input:
         xmax=float(line.split()[-1])
     if "ftrajectories" in line:
         ftrajectories=line.split()[-1]
-
-file_num=len(os.listdir(f"./folder_{ftrajectories}"))
+ftrajectories=strip_compression(ftrajectories)
+# encounter trajectories extracted with several cutoffs are in folder_cut<cut>_ftrajectories
+folder=encounter_folder(ftrajectories, argument.cut)
+
+# encounter trajectories written by Get_encounter_traj.py --store are read from folder_ftrajectories.npz,
+# and the xyz coordinates are written in the same way in folder_ftrajectories_xyz.npz
+use_store=os.path.exists(store_path(folder))
+if use_store:
+    segments, metadata=load_store(store_path(folder))
+    file_num=len(segments)
+else:
+    file_num=len(os.listdir(f"./{folder}"))
+xyz_segments=[]
 
 L=xmax-xmin
 D=L/2
 
 #p2=md.load("p2_noh.pdb")
 #p1=md.load("p1_noh.pdb")
-p1_noh_file=sys.argv[2]
-p2_noh_file=sys.argv[3]
+p1_noh_file=argument.p1_noh
+p2_noh_file=argument.p2_noh
 p2=md.load(p2_noh_file)
 p1=md.load(p1_noh_file)
 p2_com=md.compute_center_of_mass(p2)*10
 p1_com=md.compute_center_of_mass(p1)*10
 
-if os.path.exists(f"folder_{ftrajectories}_xyz"):
-    shutil.rmtree(f"folder_{ftrajectories}_xyz")
-os.mkdir(f"folder_{ftrajectories}_xyz")
-
-
-for t in tqdm(range(1,file_num+1)):
-    subfile_traj=f"./folder_{ftrajectories}/{ftrajectories}_{t}"
-    #subfile_traj=f"trajectories_1_{t}"
-    with open(subfile_traj,"r") as fin:
-        lines_fin=fin.readlines()
-
-
-    with open(f"folder_{ftrajectories}_xyz/{ftrajectories}_{t}_xyz","w+") as fout:
-    #with open(subfile_traj+"_xyz","w+") as fout:
-        for line_fin in lines_fin[2:]:
-            if int(line_fin.split()[2])==1:
-                tx=float(line_fin.split()[3])
-                ty=float(line_fin.split()[4])
-                tz=float(line_fin.split()[5])
-                r1x=float(line_fin.split()[6])
-                r1y=float(line_fin.split()[7])
-                r1z=float(line_fin.split()[8])
-                r2x=float(line_fin.split()[9])
-                r2y=float(line_fin.split()[10])
-                r2z=float(line_fin.split()[11])
-                r3x=r1y*r2z-r1z*r2y
-                r3y=r1z*r2x-r1x*r2z
-                r3z=r1x*r2y-r1y*r2x
+# the com of solute 2 depends only on the position of its geometric center in its own
+# reference system: one vector to transform per frame instead of all the atoms
+p2_body=p2.xyz[0]*10-p2_com[0]
+center_offset=p2_body.mean(axis=0, keepdims=True)
 
-                RP=np.zeros((3,3))
-                RP[0,:]=r1x,r1y,r1z
-                RP[1,:]=r2x,r2y,r2z
-                RP[2,:]=r3x,r3y,r3z
-                RP=RP.transpose()#magari da cancellare
-                
+remove_output(f"{folder}_xyz")
+if not use_store:
+    os.mkdir(f"{folder}_xyz")
+if argument.full_atom:
+    remove_output(f"{folder}_atoms")
+    os.mkdir(f"{folder}_atoms")
+    p2_elements=[atom.element.symbol for atom in p2.topology.atoms]
 
-            if int(line_fin.split()[2])==2:
-                delta_tx=float(line_fin.split()[3])-tx
-                delta_ty=float(line_fin.split()[4])-ty
-                delta_tz=float(line_fin.split()[5])-tz
-
-
-                delta_vec=np.array([delta_tx, delta_ty, delta_tz])
-                delta_vec = delta_vec-L*np.round(delta_vec/L)
-
-                r1xl=float(line_fin.split()[6])
-                r1yl=float(line_fin.split()[7])
-                r1zl=float(line_fin.split()[8])
-                r2xl=float(line_fin.split()[9])
-                r2yl=float(line_fin.split()[10])
-                r2zl=float(line_fin.split()[11])
-                r3xl=r1yl*r2zl-r1zl*r2yl
-                r3yl=r1zl*r2xl-r1xl*r2zl
-                r3zl=r1xl*r2yl-r1yl*r2xl
-                Rl=np.zeros((3,3))
-                Rl[0,:]=r1xl,r1yl,r1zl
-                Rl[1,:]=r2xl,r2yl,r2zl
-                Rl[2,:]=r3xl,r3yl,r3zl
-                Rl=Rl.transpose()#magari da cancellare
-                
-                new_lig_pos=np.zeros((p2.xyz[0]).shape)
-                
-                for i,atom in enumerate(p2.xyz[0]):
-                    new_lig_pos[i]=RP.transpose()@(Rl@(atom*10-p2_com[0])+delta_vec)
-                    
-                
-                new_com_lig=np.zeros((3))
-                for atom in new_lig_pos:
-                    new_com_lig+=atom
-                new_com_lig=new_com_lig/len(new_lig_pos)
-                
-                
-                xsim='{0:.3f}'.format(new_com_lig[0]+p1_com[0][0]).rjust(7)
-                ysim='{0:.3f}'.format(new_com_lig[1]+p1_com[0][1]).rjust(7)
-                zsim='{0:.3f}'.format(new_com_lig[2]+p1_com[0][2]).rjust(7)
-                
-                newline=xsim+" "+ysim+" "+zsim+"\n"
-
-                fout.write(newline)
-
-
-if os.path.exists(f"folder_{ftrajectories}_vmd"):
-    shutil.rmtree(f"folder_{ftrajectories}_vmd")
-os.mkdir(f"folder_{ftrajectories}_vmd")
 
 for t in tqdm(range(1,file_num+1)):
-    coordinates = []
-    with open(f"folder_{ftrajectories}_xyz/{ftrajectories}_{t}_xyz","r") as fin:
-        lines=fin.readlines()
-        for line in lines:
-            coordinates.append((float(line.split()[0]), float(line.split()[1]), float(line.split()[2])))
-    create_pdb_from_coordinates(coordinates, f"./folder_{ftrajectories}_vmd/output_1_{t}.pdb")
-
+    if use_store:
+        records=parse_lines(segments[t-1])
+    else:
+        subfile_traj=resolve_path(f"./{folder}/{ftrajectories}_{t}")
+        #subfile_traj=f"trajectories_1_{t}"
+        records=read_trajectory(subfile_traj)
+
+    # ligand center in the sda frame, relative to p1, then brought in the p1 reference system
+    lig_rows, lig_center=ligand_positions(records, center_offset, L)
+    new_lines=xyz_lines(lig_center[:,0], p1_com[0])
+
+    if argument.full_atom:
+        # all the ligand atoms, in the same way
+        lig_rows, new_lig_pos=ligand_positions(records, p2_body, L)
+        new_lig_pos+=p1_com[0]
+        with open_file(compressed_name(f"{folder}_atoms/{ftrajectories}_{t}_atoms.xyz", argument.compress),"w+") as fout:
+            for frame,positions in zip(records["frame"][lig_rows], new_lig_pos):
+                fout.write(f"{len(p2_elements)}\n")
+                fout.write(f"frame {frame}\n")
+                for element,(x,y,z) in zip(p2_elements, positions):
+                    fout.write(f"{element:2s} {x:10.3f} {y:10.3f} {z:10.3f}\n")
+
+    # same (rounded) values as reading back the xyz file
+    xyz_segments.append(np.fromstring("".join(new_lines), dtype=np.float64, sep=" ").reshape(-1, 3))
+    if not use_store:
+        with open_file(compressed_name(f"{folder}_xyz/{ftrajectories}_{t}_xyz", argument.compress),"w+") as fout:
+        #with open(subfile_traj+"_xyz","w+") as fout:
+            fout.writelines(new_lines)
+
+if use_store:
+    write_store(store_path(f"{folder}_xyz"), xyz_segments, runs=metadata["runs"], compress=argument.compress is not None)
+
+remove_vmd_output(f"{folder}_vmd")
+
+if argument.vmd_format!="pdb":
+    # all the trajectories in a single binary file, from the coordinates in memory
+    write_vmd_trajectory(f"{folder}_vmd", xyz_segments, argument.vmd_format)
+elif not use_store:
+    # the pdb files for vmd are one per trajectory: not written with the store
+    os.mkdir(f"{folder}_vmd")
+    for t,coordinates in enumerate(tqdm(xyz_segments), start=1):
+        write_points_pdb(f"./{folder}_vmd/output_1_{t}.pdb", coordinates)
@@ -2,186 +2,255 @@ import sys
 import numpy as np
 import os
 import shutil
+import pickle
 from deeptime.markov.msm import MaximumLikelihoodMSM
 from deeptime.markov import TransitionCountEstimator
 from deeptime.markov.msm import BayesianMSM
+from deeptime.markov.msm import MarkovStateModel
+from scipy import sparse
 from tqdm import tqdm
-from deeptime.clustering import KMeans
 import matplotlib.pyplot as plt
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from deeptime.plots import plot_markov_model
 import matplotlib as mpl
 from deeptime.plots.chapman_kolmogorov import plot_ck_test
 import networkx as nx
+from msm_clustering import cached_clustering, features_digest, wcss, CLUSTERING_METHODS, DEFAULT_BATCH_SIZE, DEFAULT_CLUSTER_CACHE_SIZE
+from msm_analysis import estimate_msm, leading_eigenpairs, active_set, DEFAULT_N_TIMESCALES
+from segment_store import load_features, split_features
 
 
-def eucl_norm(data, cluster):
+# Results of the analysis saved in the output folder: wcss values, count models and MSMs of every
+# lagtime, read back by --replot
+RESULTS_FILE = "validate_results.pkl"
+
+# Data of the processes of the wcss analysis, set once per process by _init_wcss
+_wcss_data={}
+
+
+def _init_wcss(folders, use_cache, options):
+    """
+    Loads the features in a process of the wcss analysis (memory mapped from the features cache)
+    """
+    _wcss_data["features"]=load_features(folders, use_cache=use_cache)[0]
+    _wcss_data["options"]=options
+
+
+def wcss_point(num_clus):
     """
-    Function for computinf euclidean norm between two euclidean points
+    Function computing the wcss for a number of clusters
 
     Input:
-        data: 3 coordinates point
-        cluster: 3 coordinates point
-    Retunr:
-        euclidean norm between data and cluster
+        num_clus: number of clusters
+    Return:
+        wcss and its standard deviation
     """
-    return np.sqrt(np.sum((data-cluster)**2))
+    features=_wcss_data["features"]
+    seed_kmeans, max_iter_kmeans, clustering, batch_size, cache_size, digest=_wcss_data["options"]
+    #compute clusters with kmeans (or read them from the cache of the clusterings),
+    #one thread per process, the processes run in parallel
+    clustering_new, dtraj = cached_clustering(features, num_clus, seed_kmeans, max_iter_kmeans, init_strategy='uniform',
+                                              method=clustering, batch_size=batch_size, n_jobs=1, max_size=cache_size, digest=digest)
+    return wcss(clustering_new.cluster_centers, features, dtraj)
 
 
-def main(args):
+def estimate_lag_model(dtrajs, lag, sparse_mode=False, reversible=True):
     """
-    main function
+    Function estimating the MSM of a lagtime
 
-    1. Run wcss vs num cluster analysis
-    2. For a specific number of cluster build eigenvalues for different lagtimes
-    3. Run Chapman-Kolmogorov Test for MSM with provided num of clusters
+    Input:
+        dtrajs: discrete trajectories
+        lag: lagtime
+        sparse_mode: if True, sparse maximum likelihood MSM on the largest connected set instead of the bayesian MSM
+        reversible: reversible sparse MSM (sparse mode only, the prior of the bayesian MSM is reversible)
+    Return:
+        count model and MSM of the lagtime
     """
+    if sparse_mode:
+        msm = estimate_msm(dtrajs, lag, reversible=reversible, sparse_mode=True, count_mode="effective")
+        return msm.count_model, msm
+    counts = TransitionCountEstimator(lagtime=lag, count_mode="effective").fit(dtrajs).fetch_model()
+    msm = BayesianMSM().fit(counts).fetch_model()
+    #for MaximumLikelihood MSMS is slightly different the command
+    #msm = MaximumLikelihoodMSM(lagtime=lag, reversible=reversible_input, allow_disconnected=allow_disconnected_input).fit_fetch(dtrajs)
+    return counts, msm
 
-    #create output folder
-    if os.path.exists(args.output_folder):
-        shutil.rmtree(args.output_folder)
-    os.mkdir(args.output_folder)
 
-    # Load data
-    data=[]
-    for num in args.list_enc:
-        for file in os.listdir("./"+args.folder_prefix+"_"+str(num)+"_xyz"):
-        #if "trajectories_1" in file:
-            data.append(np.loadtxt("./"+args.folder_prefix+"_"+str(num)+"_xyz/"+file))
+def lag_msm(msm):
+    """
+    Maximum likelihood MSM of a lagtime: the prior of the bayesian MSM, or the sparse MSM
+    """
+    return msm.prior if hasattr(msm, "prior") else msm
 
-    # Define the target clusters
-    print(f"Running wcss analysis with number of clusters = [1,20]")
-    num_clusters=np.arange(1,20,1)
-    wcss_values=[]
-    wcss_values_std=[]
-    #for each number of cluster get wcss function
-    for numi_clus in tqdm(num_clusters):
-        #compute clusters with kmeans
-        estimator = KMeans(
-            n_clusters=numi_clus,  # place 100 cluster centers
-            init_strategy='uniform',  # kmeans++ initialization strategy
-            max_iter=0,  # don't actually perform the optimization, just place centers
-            fixed_seed=args.seed_kmeans
-        )
-        
-        #fit data into clusters
-        clustering = estimator.fit(np.concatenate(data)).fetch_model()
-        assignments = clustering.transform(np.concatenate(data))
-        estimator.initial_centers = clustering.cluster_centers
-        estimator.max_iter = args.max_iter_kmeans
-        clustering_new = estimator.fit(np.concatenate(data)).fetch_model()
-
-        dtrajs = [estimator.transform(t) for t in data]
-        
-        #compute wcss for those clusters
-        wcss=0
-        tot_frame=0
-        for d,dtraj in enumerate(dtrajs):
-            for t,frame in enumerate(dtraj):
-                wcss+=eucl_norm(data[d][t], clustering_new.cluster_centers[dtrajs[d][t]])**2
-                tot_frame+=1
-        wcss=wcss/tot_frame
-
-        #compute wcss std for those clusters
-        wcss_std=0
-        for d,dtraj in enumerate(dtrajs):
-            for t,frame in enumerate(dtraj):
-                wcss_std+=(eucl_norm(data[d][t], clustering_new.cluster_centers[dtrajs[d][t]])**2-wcss)**2
-        wcss_std=np.sqrt(wcss_std/tot_frame)
-
-        
-        wcss_values.append(wcss)
-        wcss_values_std.append(wcss_std)
 
+def plot_wcss(output_folder, num_clusters, wcss_values):
+    """
+    Plot of the wcss vs num cluster analysis
+    """
     plt.figure()
     plt.scatter(num_clusters,wcss_values)
     plt.xticks(num_clusters)
     plt.ylabel("WCSS [Ang]")
     plt.xlabel("k number of cluster")
-    plt.savefig(args.output_folder+"/wcss_analysis")
-
-
-    #Build MSM and eigenvalue analysis for input number of clusters
-
-    #Build first the clusters with the provided num of clusters
-    estimator = KMeans(
-        n_clusters=args.num_clus,  # place 100 cluster centers
-        init_strategy='uniform',  # kmeans++ initialization strategy
-        max_iter=0,  # don't actually perform the optimization, just place centers
-        fixed_seed=args.seed_kmeans
-    )
-
-    #cluster data into clusters
-    clustering = estimator.fit(np.concatenate(data)).fetch_model()
-    assignments = clustering.transform(np.concatenate(data))
-    estimator.initial_centers = clustering.cluster_centers
-    estimator.max_iter = args.max_iter_kmeans
-    clustering_new = estimator.fit(np.concatenate(data)).fetch_model()
-
-    dtrajs = [estimator.transform(t) for t in data]
+    plt.savefig(output_folder+"/wcss_analysis")
 
-    #define lagtimes to try
-    lagtimes=np.arange(1,8,1)
 
+def plot_implied_timescales(output_folder, lagtimes, msms, num_clus, n_timescales=None):
+    """
+    Plot of the implied timescales of the MSMs of every lagtime (only the n_timescales leading
+    ones, from the iterative solver, if provided)
+    """
+    n_eiv=num_clus-1 if n_timescales is None else min(num_clus-1, n_timescales)
     #initialise eigenvalues arrays
-    eigenv_relax=np.zeros((args.num_clus-1,len(lagtimes)))
-
-    #for each lagtime, build MSM and compute eigenvalues implied timescales
-    for i,lag in enumerate(lagtimes):
-        counts = TransitionCountEstimator(lagtime=lag, count_mode="effective").fit(dtrajs).fetch_model()
-        msm = BayesianMSM().fit(counts).fetch_model()
-        #for MaximumLikelihood MSMS is slightly different the command
-        #msm = MaximumLikelihoodMSM(lagtime=lag, reversible=reversible_input, allow_disconnected=allow_disconnected_input).fit_fetch(dtrajs)
+    eigenv_relax=np.zeros((n_eiv,len(lagtimes)))
+
+    #for each lagtime, eigenvalues implied timescales
+    for i,msm in enumerate(msms):
         try:
-            for eiv in range(args.num_clus-1):
-                eigenv_relax[eiv,i]=msm.prior.timescales()[eiv]
+            timescales=lag_msm(msm).timescales() if n_timescales is None else leading_eigenpairs(msm, n_eiv)[0]
+            for eiv in range(n_eiv):
+                eigenv_relax[eiv,i]=timescales[eiv]
                 #eigenv_relax[eiv,i]=msm.timescales()[eiv]
         except:
             pass
-    
+
     plt.figure()
-    for eiv in range(args.num_clus-1):
+    for eiv in range(n_eiv):
         plt.plot(eigenv_relax[eiv])
     plt.xticks(ticks=lagtimes-1, labels=lagtimes)
     plt.xlabel("Lagtimes [unit]")
     plt.ylabel("Eigenvalues [unit]")
-    plt.savefig(args.output_folder+"/implied_timescales")
-
+    plt.savefig(output_folder+"/implied_timescales")
 
-    #Chapman-Kolmogorov Test for MSM with provided num of clusters
-    models = []
 
-    eigenv_relax=np.zeros((args.num_clus-1,len(lagtimes)))
-    for i,lag in enumerate(lagtimes):
-        counts = TransitionCountEstimator(lagtime=lag, count_mode="effective").fit(dtrajs).fetch_model()
-        msm = BayesianMSM().fit(counts).fetch_model().prior
-        models.append(msm)
+def plot_ck(output_folder, msms):
+    """
+    Plot of the Chapman-Kolmogorov Test of the MSMs of every lagtime
+    """
+    models = [lag_msm(msm) for msm in msms]
+    if any(sparse.issparse(model.transition_matrix) for model in models):
+        #PCCA+ needs dense matrices, and the same states at all the lagtimes
+        if any(not np.array_equal(active_set(model), active_set(models[0])) for model in models):
+            print("Chapman-Kolmogorov Test skipped: the largest connected set changes with the lagtime")
+            return
+        models = [MarkovStateModel(model.transition_matrix.toarray(), stationary_distribution=model.stationary_distribution,
+                                   reversible=model.reversible, lagtime=model.lagtime, count_model=model.count_model) for model in models]
 
     test_model = models[0]
     plt.figure()
     ck_test = test_model.ck_test(models, n_metastable_sets=6)
     _ = plot_ck_test(ck_test, legend=True)
     plt.suptitle("Chapman-Kolmogorov Test")
-    plt.savefig(args.output_folder+"/ck_test")
+    plt.savefig(output_folder+"/ck_test")
+
+
+def main(args):
+    """
+    main function
+
+    1. Run wcss vs num cluster analysis
+    2. For a specific number of cluster build eigenvalues for different lagtimes
+    3. Run Chapman-Kolmogorov Test for MSM with provided num of clusters
+
+    The results of 1. and the models of every lagtime are saved in the output folder (RESULTS_FILE),
+    and with --replot the plots are made again from them without any estimation
+    """
+    if args.replot:
+        with open(os.path.join(args.output_folder, RESULTS_FILE), "rb") as fin:
+            results=pickle.load(fin)
+        plot_wcss(args.output_folder, results["num_clusters"], results["wcss"])
+        plot_implied_timescales(args.output_folder, results["lagtimes"], results["msms"], results["num_clus"], results.get("n_timescales"))
+        plot_ck(args.output_folder, results["msms"])
+        return
+
+    #create output folder
+    if os.path.exists(args.output_folder):
+        shutil.rmtree(args.output_folder)
+    os.mkdir(args.output_folder)
+
+    # Load data
+    #xyz files of the folders, or their segment stores folder_prefix_num_xyz.npz, as a single array:
+    #read once and then memory mapped from folder_prefix_num_xyz.features.npy
+    features, offsets = load_features(["./"+args.folder_prefix+"_"+str(num)+"_xyz" for num in args.list_enc], use_cache=not args.no_feature_cache)
+
+    # Define the target clusters
+    print(f"Running wcss analysis with number of clusters = [{args.k_min},{args.k_max}]")
+    num_clusters=np.arange(args.k_min,args.k_max+1,1)
+    folders=["./"+args.folder_prefix+"_"+str(num)+"_xyz" for num in args.list_enc]
+    #hash of the features for the cache of the clusterings, computed once
+    digest=features_digest(features) if args.cluster_cache_size>0 else None
+    options=(args.seed_kmeans, args.max_iter_kmeans, args.clustering, args.batch_size, args.cluster_cache_size, digest)
+    #for each number of cluster get wcss function, the numbers of clusters in parallel
+    with ProcessPoolExecutor(max_workers=args.n_jobs, initializer=_init_wcss, initargs=(folders, not args.no_feature_cache, options)) as executor:
+        results=list(tqdm(executor.map(wcss_point, num_clusters.tolist()), total=len(num_clusters)))
+    wcss_values=[result[0] for result in results]
+    wcss_values_std=[result[1] for result in results]
+
+
+    #Build MSM and eigenvalue analysis for input number of clusters
+
+    #Build first the clusters with the provided num of clusters
+    clustering_new, dtraj = cached_clustering(features, args.num_clus, args.seed_kmeans, args.max_iter_kmeans, init_strategy='uniform',
+                                              method=args.clustering, batch_size=args.batch_size, max_size=args.cluster_cache_size, digest=digest)
+
+    #all the frames are assigned through a k-d tree of the centers, then split in the trajectories
+    dtrajs = split_features(dtraj, offsets)
+
+    #define lagtimes to try
+    lagtimes=np.arange(1,8,1)
+
+    #build the MSM of each lagtime once, the lagtimes in parallel: the same models are used for
+    #the implied timescales and the Chapman-Kolmogorov Test
+    #with --sparse, sparse MSMs (reversible unless --no-reversible) with only the leading timescales
+    reversible=args.reversible is not False
+    with ProcessPoolExecutor(max_workers=min(args.n_jobs, len(lagtimes))) as executor:
+        lag_models=list(executor.map(estimate_lag_model, [dtrajs]*len(lagtimes), lagtimes.tolist(), [args.sparse]*len(lagtimes), [reversible]*len(lagtimes)))
+    n_timescales=args.n_timescales if args.sparse else None
+    counts=[lag_model[0] for lag_model in lag_models]
+    msms=[lag_model[1] for lag_model in lag_models]
+
+    with open(os.path.join(args.output_folder, RESULTS_FILE), "wb") as fout:
+        pickle.dump({"num_clusters":num_clusters, "wcss":wcss_values, "wcss_std":wcss_values_std, "num_clus":args.num_clus,
+                     "cluster_centers":clustering_new.cluster_centers, "lagtimes":lagtimes, "counts":counts, "msms":msms, "n_timescales":n_timescales}, fout)
+
+    plot_wcss(args.output_folder, num_clusters, wcss_values)
+
+    plot_implied_timescales(args.output_folder, lagtimes, msms, args.num_clus, n_timescales)
+
+    #Chapman-Kolmogorov Test for MSM with provided num of clusters
+    plot_ck(args.output_folder, msms)
 
 
 
 if __name__ == "__main__":
 
     # Set up argument parser
-    parser = argparse.ArgumentParser(description="Validate Markov State Models",
+    parser = argparse.ArgumentParser(description="Validate Markov State Models", fromfile_prefix_chars="@",
                                      epilog="Example usage:\n"
                                      "python Validate_MSM.py --folder_prefix folder_trajectories --output_folder validate_folder --list_enc 3 6 16 46 48")
-    parser.add_argument("--folder_prefix", type=str, required=True, help="prefix for the folder containing xyz files e.g. folder_trajectories")
-    parser.add_argument("--list_enc", nargs="+", type=int, required=True, help="list of trajectory files containing encountered complexes")
+    parser.add_argument("--folder_prefix", type=str, required=False, help="prefix for the folder containing xyz files e.g. folder_trajectories")
+    parser.add_argument("--list_enc", nargs="+", type=int, required=False, help="list of trajectory files containing encountered complexes (or @file, e.g. the --output of find_encounter_files.py)")
     parser.add_argument("--output_folder", type=str, required=True, help="output folder where to save plots")
     parser.add_argument("--num_clus", type=int, required=False, default=6, help="Number of clusters for MSM")
     parser.add_argument("--seed_kmeans", type=int, required=False, default=1, help="Seed for KMeans evaluation")
     parser.add_argument("--max_iter_kmeans", type=int, required=False, default=50000, help="Max number of iterations for KMeans evaluation")
     parser.add_argument("--allow_disconnected", action=argparse.BooleanOptionalAction, help="use flag for disconnected MSM")
     parser.add_argument("--reversible", action=argparse.BooleanOptionalAction, help="use flag for reversible MSM")
+    parser.add_argument("--clustering", type=str, required=False, default="kmeans", choices=CLUSTERING_METHODS, help="kmeans (default): KMeans over all the frames, minibatch: KMeans fitted on random mini-batches of frames, for datasets too large for memory")
+    parser.add_argument("--batch_size", type=int, required=False, default=DEFAULT_BATCH_SIZE, help="Frames per mini-batch with --clustering minibatch (--max_iter_kmeans is then the number of mini-batches)")
+    parser.add_argument("--k_min", type=int, required=False, default=1, help="Smallest number of clusters of the wcss analysis")
+    parser.add_argument("--k_max", type=int, required=False, default=19, help="Largest number of clusters of the wcss analysis")
+    parser.add_argument("--n_jobs", type=int, required=False, default=os.cpu_count(), help="Number of processes of the wcss analysis and of the MSMs of the lagtimes, by default all the cores")
+    parser.add_argument("--cluster_cache_size", type=float, required=False, default=DEFAULT_CLUSTER_CACHE_SIZE, help="Size limit (MB) of the cache of the clusterings in .msm_cluster_cache, the least recently used are removed; 0 to disable it")
+    parser.add_argument("--no_feature_cache", action="store_true", help="always read the xyz files and do not write the features cache")
+    parser.add_argument("--sparse", action="store_true", help="sparse MSMs for many states (hundreds to thousands): sparse matrices restricted to the largest connected set, only the leading implied timescales")
+    parser.add_argument("--n_timescales", type=int, required=False, default=DEFAULT_N_TIMESCALES, help="Number of leading implied timescales with --sparse")
+    parser.add_argument("--replot", action="store_true", help="only make the plots again from the results saved in output_folder by a previous run")
 
     # Parse arguments
     args = parser.parse_args()
+    if not args.replot and (args.folder_prefix is None or args.list_enc is None):
+        parser.error("--folder_prefix and --list_enc are required (unless --replot)")
 
     main(args)
\ No newline at end of file
@@ -0,0 +1,48 @@
+import numpy as np
+import argparse
+from msm_clustering import assign_clusters, load_centers
+from segment_store import load_features, split_features, write_store
+
+
+def main(args):
+    """
+    main function
+
+    1. Read the cluster centers saved by build_MSM.py (or build_MSM_single_folder.py)
+    2. Assign the frames of the xyz trajectories to the closest center, without fitting the clusters again
+    3. Write the discrete trajectories in a single store file
+    """
+    centers=load_centers(args.folder_msm)
+
+    if args.list_enc is None:
+        folders=[args.folder_xyz]
+    else:
+        folders=["./"+args.folder_xyz+"_"+num+"_xyz" for num in args.list_enc]
+    features, offsets = load_features(folders, use_cache=not args.no_feature_cache)
+
+    dtrajs=split_features(assign_clusters(centers, features, n_jobs=args.n_jobs), offsets)
+    write_store(args.output, dtrajs)
+
+    counts=np.bincount(np.concatenate(dtrajs), minlength=len(centers)) if dtrajs else np.zeros(len(centers), dtype=int)
+    print(f"Assigned {len(features)} frames of {len(dtrajs)} trajectories to {len(centers)} clusters")
+    for i,count in enumerate(counts):
+        print(f"cluster {i}: {count} frames")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Assign xyz trajectories to the clusters of an existing MSM. The discrete trajectories are written "
+                                     "in a single file (one trajectory after the other, read back with segment_store.load_store)", fromfile_prefix_chars="@",
+                                     epilog="Example usage:\n"
+                                     "python assign_MSM.py --folder_msm folder_MSM --folder_xyz folder_trajectories_2_xyz --output dtrajs_2.npz")
+    parser.add_argument("--folder_msm", type=str, required=True, help="MSM folder written by build_MSM.py, with cluster_centers.npy (or the path of the centers file)")
+    parser.add_argument("--folder_xyz", type=str, required=True, help="folder with the xyz files (or its segment store), or their prefix with --list_enc")
+    parser.add_argument("--list_enc", nargs="+", required=False, default=None, help="list of integers of the folders with the encounter traj inside, as for build_MSM.py (or @file)")
+    parser.add_argument("--output", type=str, required=True, help="output file with the discrete trajectories, e.g. dtrajs.npz")
+    parser.add_argument("--n_jobs", type=int, required=False, default=-1, help="number of threads, by default all the cores")
+    parser.add_argument("--no_feature_cache", action="store_true", help="always read the xyz files and do not write the features cache")
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    main(args)
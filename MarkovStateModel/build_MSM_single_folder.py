@@ -2,14 +2,16 @@ import sys
 import numpy as np
 import os
 import shutil
-from deeptime.markov.msm import MaximumLikelihoodMSM
 from tqdm.notebook import tqdm  # progress bar (optional)
-from deeptime.clustering import KMeans
 import matplotlib.pyplot as plt
 import argparse
 from deeptime.plots import plot_markov_model
 import matplotlib as mpl
 import networkx as nx
+from segment_store import load_features, split_features
+from msm_clustering import cached_clustering, save_centers, CLUSTERING_METHODS, DEFAULT_BATCH_SIZE, DEFAULT_CLUSTER_CACHE_SIZE
+from msm_analysis import estimate_msm, mfpt_matrix, write_msm_arrays, DEFAULT_N_TIMESCALES
+from vmd_output import write_points_pdb
 
 
 def printUsage():
@@ -34,26 +36,6 @@ def str2bool(v):
     else:
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
-def create_pdb_from_coordinates(coordinates, output_file):
-    """
-    Create a PDB file from a list of coordinates.
-    
-    Parameters:
-    - coordinates: A list of tuples, where each tuple contains the (x, y, z) positions of an atom.
-    - output_file: The name of the output PDB file.
-    """
-    
-    with open(output_file, 'w+') as pdb_file:
-        for i, (x, y, z) in enumerate(coordinates, start=1):
-            # Construct each PDB line according to the format
-            pdb_line = (
-                f"ATOM  {i:5d} CL   BEN A{i:4d}    "
-                f"{x:8.3f}{y:8.3f}{z:8.3f}  1.00  0.00          CL  \n"
-            )
-            pdb_file.write(pdb_line)
-
-
-
 parser = argparse.ArgumentParser(description = "Description for my parser")
 parser.add_argument("--folder_xyz", help = "Folder which contains xyz files", type=str, required = True)
 parser.add_argument("--folder_msm", help = "Folder where to save MarkovStateModel, it exists, overwrite", type=str,required = True)
@@ -64,6 +46,15 @@ parser.add_argument("--max_iter_kmeans", help = "Max iteration in KMeans cluster
 #parser.add_argument("--allow_disconnected", help = "If set, allow disconnected states in the MSM (not recommended)", action=argparse.BooleanOptionalAction)
 parser.add_argument("--allow_disconnected", help = "If true, allow disconnected states in the MSM (not recommended)", type=str2bool, default=False)
 parser.add_argument("--reversible", help = "If true, MSM constrained to satisfy detail balanced, default=False", type=str2bool, default=False)
+parser.add_argument("--single_centers_pdb", help = "If set, write all the cluster centers in a single cluster_centers.pdb (atom i+1 is cluster i) instead of one cluster_i.pdb file each", action="store_true")
+parser.add_argument("--clustering", help = "kmeans (default): KMeans over all the frames, minibatch: KMeans fitted on random mini-batches of frames, for datasets too large for memory", type=str, required = False, default="kmeans", choices=CLUSTERING_METHODS)
+parser.add_argument("--batch_size", help = "Frames per mini-batch with --clustering minibatch (--max_iter_kmeans is then the number of mini-batches)", type=int, required = False, default=DEFAULT_BATCH_SIZE)
+parser.add_argument("--n_jobs", help = "Number of threads assigning the frames to the clusters, by default all the cores", type=int, required = False, default=-1)
+parser.add_argument("--sparse", help = "If set, sparse MSM for many states (hundreds to thousands): sparse matrices restricted to the largest connected set, only the leading timescales, observed transitions only in msm_rates, no msm_network, mfpts only to the --mfpt_states (no msm_mfpt without them)", action="store_true")
+parser.add_argument("--mfpt_states", help = "Target states of the mfpts in msm_mfpt (e.g. 0 12 57), one linear solve each; by default all the states, none with --sparse", type=int, nargs="+", required = False, default=None)
+parser.add_argument("--n_timescales", help = "Number of leading timescales and eigenvectors saved in msm_arrays.npz with --sparse", type=int, required = False, default=DEFAULT_N_TIMESCALES)
+parser.add_argument("--cluster_cache_size", help = "Size limit (MB) of the cache of the clusterings in .msm_cluster_cache, the least recently used are removed; 0 to disable it", type=float, required = False, default=DEFAULT_CLUSTER_CACHE_SIZE)
+parser.add_argument("--no_feature_cache", help = "If set, always read the xyz files and do not write the features cache", action="store_true")
                 
 argument = parser.parse_args()
 
@@ -75,38 +66,38 @@ seed_kmeans=argument.seed_kmeans
 max_iter_kmeans=argument.max_iter_kmeans
 allow_disconnected_input=argument.allow_disconnected
 reversible_input=argument.reversible
+single_centers_pdb=argument.single_centers_pdb
 
 print()
-print(f"Running KMeans with n_clusters = {num_clus}")
+print(f"Running KMeans ({argument.clustering}) with n_clusters = {num_clus}")
 print(f"Running MSM with allow_disconnected = {allow_disconnected_input}")
 print(f"Running MSM with reversibility = {reversible_input}")
 
-data=[]
-for file in os.listdir(folder_xyz):
-    if "trajectories_1" in file:
-        data.append(np.loadtxt(f"{folder_xyz}/{file}"))
-
-estimator = KMeans(
-    n_clusters=num_clus,  # place 100 cluster centers
-    init_strategy='kmeans++',  # kmeans++ initialization strategy
-    max_iter=0,  # don't actually perform the optimization, just place centers
-    fixed_seed=seed_kmeans
-)
+#xyz files of the folder, or its segment store folder_xyz.npz, as a single array:
+#read once and then memory mapped from folder_xyz.features.npy
+features, offsets = load_features(folder_xyz, name_filter="trajectories_1", use_cache=not argument.no_feature_cache)
 
-clustering = estimator.fit(np.concatenate(data)).fetch_model()
-assignments = clustering.transform(np.concatenate(data))
-estimator.initial_centers = clustering.cluster_centers
-estimator.max_iter = max_iter_kmeans
-clustering_new = estimator.fit(np.concatenate(data)).fetch_model()
+#kmeans: KMeans over all the frames, minibatch: KMeans updated with random mini-batches of frames
+#the clustering and the cluster of every frame are read from the cache of the previous runs if the same
+#features were clustered with the same parameters (e.g. only the lagtime changed)
+clustering_new, dtraj = cached_clustering(features, num_clus, seed_kmeans, max_iter_kmeans, init_strategy='kmeans++',
+                                          method=argument.clustering, batch_size=argument.batch_size,
+                                          n_jobs=argument.n_jobs, max_size=argument.cluster_cache_size)
 
 if os.path.exists(folder_msm):
     shutil.rmtree(folder_msm)
 os.mkdir(folder_msm)
 
+#centers to assign new trajectories later with assign_MSM.py
+save_centers(folder_msm, clustering_new.cluster_centers)
+
 
-for i,cluster in enumerate(clustering_new.cluster_centers):
-    coordinates=[(cluster[0], cluster[1], cluster[2])]
-    create_pdb_from_coordinates(coordinates, f"./{folder_msm}/cluster_{i}.pdb")
+if not single_centers_pdb:
+    for i,cluster in enumerate(clustering_new.cluster_centers):
+        write_points_pdb(f"./{folder_msm}/cluster_{i}.pdb", [cluster])
+else:
+    #all the cluster centers in a single pdb, atom i+1 is cluster i
+    write_points_pdb(f"./{folder_msm}/cluster_centers.pdb", clustering_new.cluster_centers)
 
     
 
@@ -118,33 +109,65 @@ plt.title("KMeans++ inertia during training")
 plt.savefig(f"{folder_msm}/inertia_kmean_clust")
 
 
-dtrajs = [estimator.transform(t) for t in data]
+#all the frames are assigned through a k-d tree of the centers, then split in the trajectories
+dtrajs = split_features(dtraj, offsets)
 
-msm = MaximumLikelihoodMSM(lagtime=lagtime_msm, reversible=reversible_input, allow_disconnected=allow_disconnected_input).fit_fetch(dtrajs)
+#dense MSM, or with --sparse sparse MSM restricted to the largest connected set
+msm = estimate_msm(dtrajs, lagtime_msm, reversible=reversible_input, allow_disconnected=allow_disconnected_input, sparse_mode=argument.sparse)
 
-if allow_disconnected_input==False and msm.n_states != num_clus:
+if argument.sparse and msm.n_states != num_clus:
+    print(f"Sparse MSM on the largest connected set: {msm.n_states} states out of {num_clus} clusters (cluster of every state in active_set of msm_arrays.npz)")
+elif allow_disconnected_input==False and msm.n_states != num_clus:
     print("ERROR:")
     print("     Set allow_disconnected=False but found disconnected states")
     print("     Decrease number of cluster (Suggested)")
     print("     Set allow_disconnected=True (Not suggested)")
     sys.exit(2)
     
+if argument.sparse:
+    #rows of the sparse transition matrix in order of the states
+    rates=msm.transition_matrix.tocsr().sorted_indices()
+
 with open(f"./{folder_msm}/msm_rates", "w+") as fout:
     fout.write("Markov State Models transition matrix"+"\n")
     fout.write(f"Number of states = {msm.n_states}"+"\n")
     for i in range(msm.n_states):
         fout.write(f"state = {i}"+"\n")
+        if argument.sparse:
+            #only the observed transitions
+            row=slice(rates.indptr[i], rates.indptr[i+1])
+            for j,p in zip(rates.indices[row], rates.data[row]):
+                fout.write(f"p_{i}->{j} = {p}"+"\n")
+            continue
         for j in range(msm.n_states):
             fout.write(f"p_{i}->{j} = {msm.transition_matrix[i,j]}"+"\n")
             
-with open(f"./{folder_msm}/msm_mfpt", "w+") as fout:
-    fout.write("Markov State Models mean first passage time matrix"+"\n")
-    fout.write(f"Number of states = {msm.n_states}"+"\n")
-    for i in range(msm.n_states):
-        fout.write(f"state = {i}"+"\n")
-        for j in range(msm.n_states):
-            fout.write(f"mfpt_{i}->{j} = {msm.mfpt(i,j)}"+"\n")
+#mfpts to the target states, one linear solve per target state: all the states by default,
+#only the --mfpt_states with --sparse (all the pairs of thousands of states are too many)
+mfpt_states=argument.mfpt_states
+if mfpt_states is None and not argument.sparse:
+    mfpt_states=list(range(msm.n_states))
+if mfpt_states is not None and not all(0<=j<msm.n_states for j in mfpt_states):
+    print("ERROR:")
+    print(f"     --mfpt_states must be states of the MSM, between 0 and {msm.n_states-1}")
+    sys.exit(2)
+mfpt=None
+if mfpt_states:
+    mfpt=mfpt_matrix(msm, mfpt_states)
+
+    with open(f"./{folder_msm}/msm_mfpt", "w+") as fout:
+        fout.write("Markov State Models mean first passage time matrix"+"\n")
+        fout.write(f"Number of states = {msm.n_states}"+"\n")
+        for i in range(msm.n_states):
+            fout.write(f"state = {i}"+"\n")
+            for t,j in enumerate(mfpt_states):
+                fout.write(f"mfpt_{i}->{j} = {mfpt[i,t]}"+"\n")
+
+#same results as binary arrays, read with msm_analysis.load_msm_arrays
+write_msm_arrays(folder_msm, msm, mfpt, n_timescales=argument.n_timescales, mfpt_states=argument.mfpt_states)
             
-plt.figure(figsize=(15,15))
-plot_markov_model(msm)
-plt.savefig(f"./{folder_msm}/msm_network")
+#the network of hundreds of states is not readable
+if not argument.sparse:
+    plt.figure(figsize=(15,15))
+    plot_markov_model(msm)
+    plt.savefig(f"./{folder_msm}/msm_network")
@@ -0,0 +1,171 @@
+import sys
+import os
+import argparse
+import numpy as np
+import mdtraj as md
+from tqdm import tqdm
+import warnings
+warnings.filterwarnings("ignore")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tools"))
+from sda_trajectory import iter_runs, read_header, parse_lines, DEFAULT_CHUNK_SIZE
+from sda_trajectory import open_file, resolve_path, strip_compression, compressed_name
+from sda_encounter import read_complexes, encounter_segments, encounter_folder, center_sda_lines, ligand_positions, xyz_lines
+from segment_store import store_path, remove_output, write_store
+from vmd_output import write_vmd_trajectory, write_points_pdb, remove_vmd_output, VMD_FORMATS
+
+
+class Output:
+    """
+    One output of the pipeline (e.g. the xyz trajectories of a cutoff): written one
+    file per encounter trajectory in a folder, or as a single segment store
+    """
+    def __init__(self, folder, suffix, use_store, compress):
+        self.folder=folder
+        self.suffix=suffix
+        self.use_store=use_store
+        self.compress=compress
+        self.segments=[]
+        remove_output(folder)
+        if not use_store:
+            os.mkdir(folder)
+
+    def write(self, name, segment):
+        """
+        Writes one encounter trajectory (text lines, or xyz coordinates for the store)
+        """
+        if self.use_store:
+            self.segments.append(segment)
+        else:
+            with open_file(compressed_name(f"./{self.folder}/{name}{self.suffix}", self.compress),"w+") as fout:
+                fout.writelines(segment)
+
+    def close(self, runs, header=""):
+        """
+        Writes the segment store, if used
+        """
+        if self.use_store:
+            write_store(store_path(self.folder), self.segments, runs=runs, header=header, compress=self.compress is not None)
+
+
+def main(args):
+    """
+    Main function
+    """
+    with open(args.sda_input_file, "r") as fin:
+        lines_sda_input=fin.readlines()
+    for line in lines_sda_input:
+        if "xmin" in line:
+            xmin=float(line.split()[-1])
+        if "xmax" in line:
+            xmax=float(line.split()[-1])
+        if "fcomplexes" in line:
+            fcomplexes=line.split()[-1]
+        if "ftrajectories" in line:
+            ftrajectories=line.split()[-1]
+    L=xmax-xmin
+    cuts=args.cut
+
+    # trajectory and complexes files can be compressed (e.g. trajectories_1.gz)
+    trajectory_file=resolve_path(ftrajectories)
+    complexes_file=resolve_path(fcomplexes)
+    ftrajectories=strip_compression(ftrajectories)
+    header_lines=read_header(trajectory_file)
+    header="".join(header_lines)
+
+    # first encounter frame and complex of every run
+    trajs_frames, complexed_lines=read_complexes(complexes_file)
+    complexed_records={run:parse_lines(p1_line+p2_line) for run,(p1_line,p2_line) in complexed_lines.items()}
+
+    p1=md.load(args.p1_noh)
+    p2=md.load(args.p2_noh)
+    p1_com=md.compute_center_of_mass(p1)[0]*10
+    p2_com=md.compute_center_of_mass(p2)[0]*10
+    # the com of the ligand depends only on the position of its geometric center in its own reference system
+    center_offset=(p2.xyz[0]*10-p2_com).mean(axis=0, keepdims=True)
+
+    # outputs of every cutoff: the same as Get_encounter_traj.py, Create_allign_enco_traj.py and
+    # Create_xyz_encoun_traj.py, but only the xyz trajectories are written by default
+    outputs={}
+    folders={}
+    for cut in cuts:
+        folder=encounter_folder(ftrajectories, None if len(cuts)==1 else cut)
+        folders[cut]=folder
+        outputs[cut]={"xyz":Output(f"{folder}_xyz", "_xyz", args.store, args.compress)}
+        if args.write_segments:
+            outputs[cut]["segments"]=Output(folder, "", args.store, args.compress)
+        if args.write_center_sda:
+            outputs[cut]["center_sda"]=Output(f"{folder}_center_sda", "_center", args.store, args.compress)
+        if args.write_vmd:
+            remove_vmd_output(f"{folder}_vmd")
+            if args.vmd_format=="pdb":
+                os.mkdir(f"{folder}_vmd")
+            outputs[cut]["vmd"]=[]
+
+    file_num=1
+    runs=[]
+    chunk_size=None if args.chunk_size is None else int(args.chunk_size*1024**2)
+    # each run is read once, in the order of the file, and kept in memory only while it is processed
+    # (a compressed trajectory file is decompressed once)
+    for encounter_run, records, run_lines in tqdm(iter_runs(trajectory_file, trajs_frames, chunk_size=chunk_size or DEFAULT_CHUNK_SIZE), total=len(trajs_frames)):
+        segments=encounter_segments(records, trajs_frames, cuts, L)
+        if encounter_run not in segments[cuts[0]]:
+            continue
+        runs.append(encounter_run)
+
+        for cut in cuts:
+            rows=segments[cut][encounter_run]
+            name=f"{ftrajectories}_{file_num}"
+
+            # ligand center in the reference system of p1, for the frames of the encounter trajectory
+            # and for the encounter complex
+            centers=[ligand_positions(part, center_offset, L)[1][:,0] for part in (records[rows], complexed_records[encounter_run])]
+            new_lines=xyz_lines(np.concatenate(centers), p1_com)
+            # same (rounded) values as reading back the xyz file
+            xyz=np.fromstring("".join(new_lines), dtype=np.float64, sep=" ").reshape(-1, 3)
+            outputs[cut]["xyz"].write(name, xyz if args.store else new_lines)
+
+            # optional outputs of the intermediate steps, as sda lines
+            if args.write_segments or args.write_center_sda:
+                lines=[run_lines[row] for row in rows]+list(complexed_lines[encounter_run])
+                if args.write_segments:
+                    outputs[cut]["segments"].write(name, "".join(lines) if args.store else header_lines+lines)
+                if args.write_center_sda:
+                    center_lines=center_sda_lines(lines, parse_lines("".join(lines)), L, p1_com)
+                    outputs[cut]["center_sda"].write(name, "".join(center_lines) if args.store else header_lines+center_lines)
+            if args.write_vmd and args.vmd_format=="pdb":
+                write_points_pdb(f"./{folders[cut]}_vmd/output_1_{file_num}.pdb", xyz)
+            elif args.write_vmd:
+                outputs[cut]["vmd"].append(xyz)
+        file_num+=1
+
+    for cut in cuts:
+        for key,output in outputs[cut].items():
+            if key!="vmd":
+                output.close(runs, header=header if key!="xyz" else "")
+        if args.write_vmd and args.vmd_format!="pdb":
+            write_vmd_trajectory(f"{folders[cut]}_vmd", outputs[cut]["vmd"], args.vmd_format)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Python script to extract the encounter trajectories from the trajectory file, bring them in the reference system "
+                                     "of p1 and compute the xyz coordinates of the ligand in a single pass, without intermediate files. "
+                                     "It gives the same xyz files as Get_encounter_traj.py, Create_allign_enco_traj.py and Create_xyz_encoun_traj.py in folder_ftrajectories_xyz "
+                                     "(folder_cut<cut>_ftrajectories_xyz if several cutoffs are given). The outputs of the intermediate steps are written only if requested",
+                                     epilog="Example usage:\n"
+                                     "python  encounter_pipeline.py sda.in ../data_grid/p1_noh.pdb ../data_grid/p2_noh.pdb 50")
+    parser.add_argument("sda_input_file", help = "Name of sda input file", type=str)
+    parser.add_argument("p1_noh", help = "File/path of the p1_noh.pdb", type=str)
+    parser.add_argument("p2_noh", help = "File/path of the p2_noh.pdb", type=str)
+    parser.add_argument("cut", help = "cutoff value of the com-com distance (or several values, e.g. 30 40 50 70)", type=float, nargs="+")
+    parser.add_argument("--store", help = "If set, write each output in a single file (e.g. folder_ftrajectories_xyz.npz) instead of one file per trajectory", action="store_true")
+    parser.add_argument("--write_segments", help = "If set, also write the encounter trajectories in sda format (output of Get_encounter_traj.py)", action="store_true")
+    parser.add_argument("--write_center_sda", help = "If set, also write the encounter trajectories in the reference system of p1 (output of Create_allign_enco_traj.py)", action="store_true")
+    parser.add_argument("--write_vmd", help = "If set, also write the pdb files to visualize the trajectories in vmd", action="store_true")
+    parser.add_argument("--vmd_format", help = "Format of the --write_vmd outputs: one pdb per trajectory (default), or a single dcd/xtc trajectory with all of them", type=str, required = False, default="pdb", choices=VMD_FORMATS)
+    parser.add_argument("--compress", help = "If provided, compress the output files (gz, bz2 or xz)", type=str, required = False, default=None, choices=["gz", "bz2", "xz"])
+    parser.add_argument("--chunk_size", help = "If provided, scan the trajectory file in chunks of this size (MB) when building its frame index, to bound the memory", type=float, required = False, default=None)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -1,19 +1,118 @@
 import sys
 import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tools"))
+from sda_trajectory import open_file, strip_compression, is_cache_file
 
-total_solutes = int(sys.argv[1]) # p1 + p2 + crowders
-subname = sys.argv[2]
-#files = sys.argv[3:]
-to_transfer = []
-
-for file in os.listdir("./"):
-    if subname in file:
-        with open(file,"r") as fin:
-            lines = fin.readlines()
-        if len(lines) > total_solutes + 2: # +2 because of the header in encounter complex file
-            to_transfer.append(file.replace(subname,''))
-#print(to_transfer)
-bash_string=''
-for num in to_transfer:
-    bash_string=bash_string+" "+num
-print(bash_string)
+# Verdicts of the previous runs, reused as long as the size and modification time of the file do not change
+CACHE_FILE = ".find_encounter_files_cache.json"
+
+
+def count_lines(path, max_lines=None, chunk_size=1024**2):
+    """
+    Counts the lines of a (plain or compressed) file scanning its raw bytes
+
+    Parameters:
+        path : file name
+        max_lines : if provided, stop as soon as the file is known to have more lines than this
+        chunk_size : bytes read at a time
+
+    Returns:
+        n_lines : number of lines (a lower bound, larger than max_lines, if the scan stopped early)
+        complete : True if the whole file has been scanned
+    """
+    n_lines=0
+    last=b"\n"
+    with open_file(path,"rb") as fin:
+        while True:
+            chunk=fin.read(chunk_size)
+            if not chunk:
+                break
+            n_lines+=chunk.count(b"\n")
+            last=chunk[-1:]
+            if max_lines is not None and n_lines>max_lines:
+                return n_lines, False
+    # last line without new line character
+    return n_lines+(last!=b"\n"), True
+
+
+def _count_lines(args):
+    return count_lines(*args)
+
+
+def main(args):
+    """
+    Main function
+    """
+    threshold=args.total_solutes+2 # +2 because of the header in encounter complex file
+
+    files=sorted(file for file in os.listdir("./") if args.subname in file and not is_cache_file(file) and file!=CACHE_FILE)
+
+    cache={}
+    if not args.no_cache and os.path.exists(CACHE_FILE):
+        with open(CACHE_FILE,"r") as fin:
+            cache=json.load(fin)
+
+    n_lines={}
+    to_scan=[]
+    for file in files:
+        stat=os.stat(file)
+        entry=cache.get(file)
+        if entry is not None and entry["size"]==stat.st_size and entry["mtime_ns"]==stat.st_mtime_ns:
+            # an incomplete count is only a lower bound, still valid if over the threshold
+            if entry["complete"] or entry["lines"]>threshold:
+                n_lines[file]=entry["lines"]
+                continue
+        to_scan.append(file)
+
+    # line counts of the new or modified files, in parallel
+    counts=[]
+    if to_scan:
+        with ProcessPoolExecutor(max_workers=args.n_jobs) as executor:
+            counts=list(executor.map(_count_lines, [(file, threshold) for file in to_scan]))
+    for file,(lines,complete) in zip(to_scan, counts):
+        n_lines[file]=lines
+        stat=os.stat(file)
+        cache[file]={"size":stat.st_size, "mtime_ns":stat.st_mtime_ns, "lines":lines, "complete":complete}
+
+    if not args.no_cache:
+        with open(CACHE_FILE,"w") as fout:
+            json.dump(cache, fout)
+
+    to_transfer=[]
+    for file in files:
+        if n_lines[file] > threshold:
+            to_transfer.append(strip_compression(file).replace(args.subname,''))
+    # numerical order when the files are numbered
+    to_transfer.sort(key=lambda num: (0, int(num), num) if num.isdigit() else (1, 0, num))
+
+    #print(to_transfer)
+    bash_string=''
+    for num in to_transfer:
+        bash_string=bash_string+" "+num
+    print(bash_string)
+
+    # one index per line: can be given to --list_enc of the MSM scripts as @file,
+    # or to run_batch.py as --indexes_file
+    if args.output is not None:
+        with open(args.output,"w") as fout:
+            for num in to_transfer:
+                fout.write(num+"\n")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Python script to find the complexes files with encounter complexes (more lines than the header and one frame of all the solutes)",
+                                     epilog="Example usage:\n"
+                                    "python find_encounter_files.py 1107 sdamm_complexes_ --output encounter_files.txt")
+    parser.add_argument("total_solutes", help = "total number of solutes (p1 + p2 + crowders)", type=int)
+    parser.add_argument("subname", help = "prefix of the complexes files", type=str)
+    parser.add_argument("--output", help = "If provided, write the indexes of the encounter files in this file, one per line", type=str, required = False, default=None)
+    parser.add_argument("--n_jobs", help = "number of parallel processes, by default all the cores", type=int, required = False, default=os.cpu_count())
+    parser.add_argument("--no_cache", help = "always scan the files, do not read or write the cache of the previous verdicts", action="store_true")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,208 @@
+import os
+import shutil
+import argparse
+import itertools
+import numpy as np
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
+from deeptime.markov.tools.analysis import mfpt
+from msm_clustering import cached_clustering, features_digest, CLUSTERING_METHODS, DEFAULT_BATCH_SIZE, DEFAULT_CLUSTER_CACHE_SIZE
+from msm_analysis import estimate_msm, leading_eigenpairs, active_set
+from segment_store import load_features, split_features
+
+
+# Features of the folders of every cutoff, loaded once per process (memory mapped from the features cache)
+_features={}
+
+
+def str2bool(v):
+    if isinstance(v, bool):
+        return v
+    if v.lower() in ('yes', 'true', 't', 'y', '1'):
+        return True
+    elif v.lower() in ('no', 'false', 'f', 'n', '0'):
+        return False
+    else:
+        raise argparse.ArgumentTypeError('Boolean value expected.')
+
+
+def xyz_folders(folder_xyz, list_enc, cut):
+    """
+    Folders of the xyz files of a cutoff
+
+    Input:
+        folder_xyz: prefix of the folders, with {cut} replaced by the cutoff (e.g. folder_cut{cut}_trajectories)
+        list_enc: indexes of the encounter folders
+        cut: cutoff, None if not in the grid
+    Return:
+        list of folders
+    """
+    prefix=folder_xyz if cut is None else folder_xyz.replace("{cut}", f"{cut:g}")
+    return ["./"+prefix+"_"+num+"_xyz" for num in list_enc]
+
+
+def get_features(folders, use_cache):
+    """
+    Features and trajectory offsets of a list of folders, loaded once per process
+    """
+    key=tuple(folders)
+    if key not in _features:
+        _features[key]=load_features(folders, use_cache=use_cache)
+    return _features[key]
+
+
+def cluster_task(task):
+    """
+    Function fitting the clusters of one (cutoff, number of clusters, seed) combination,
+    shared by all the MSMs with these parameters
+
+    Input:
+        task: (folders, num_clus, seed_kmeans, options) with options the other clustering arguments
+    Return:
+        cluster centers and discrete trajectories
+    """
+    folders, num_clus, seed_kmeans, options=task
+    features, offsets=get_features(folders, options["use_cache"])
+    #one thread per process, the processes run in parallel
+    clustering, dtraj=cached_clustering(features, num_clus, seed_kmeans, options["max_iter_kmeans"], init_strategy='kmeans++',
+                                        method=options["clustering"], batch_size=options["batch_size"], n_jobs=1,
+                                        max_size=options["cluster_cache_size"], digest=options["digests"].get(tuple(folders)))
+    return clustering.cluster_centers, split_features(dtraj, offsets)
+
+
+def msm_task(task):
+    """
+    Function estimating the MSM of one combination of the grid and its summary
+
+    Input:
+        task: (dtrajs, lagtime, reversible, options)
+    Return:
+        dictionary with the columns of the summary table
+    """
+    dtrajs, lagtime, reversible, options=task
+    row={"n_states":0, "connected_fraction":0.0, "bound_cluster":-1, "mfpt_to_bound":np.nan}
+    row.update({f"timescale_{t+1}":np.nan for t in range(options["n_timescales"])})
+    combination=f"cut = {options['cut']}, num_clus = {options['num_clus']}, lagtime = {lagtime}, reversible = {reversible}"
+    try:
+        msm=estimate_msm(dtrajs, lagtime, reversible=reversible, allow_disconnected=options["allow_disconnected"], sparse_mode=options["sparse"])
+    except Exception as error:
+        print(f"MSM failed for {combination}: {error}")
+        return row
+    states=active_set(msm)
+    row["n_states"]=msm.n_states
+    row["connected_fraction"]=msm.n_states/options["num_clus"]
+
+    try:
+        timescales=leading_eigenpairs(msm, options["n_timescales"])[0]
+        for t,timescale in enumerate(timescales):
+            row[f"timescale_{t+1}"]=timescale
+    except Exception as error:
+        #the timescales stay nan in the summary
+        print(f"Timescales failed for {combination}: {error}")
+
+    #bound state: cluster of most of the last frames of the trajectories (the encounter complexes),
+    #mfpt from the clusters of the first frames of the trajectories
+    last=np.array([dtraj[-1] for dtraj in dtrajs if len(dtraj)])
+    first=np.array([dtraj[0] for dtraj in dtrajs if len(dtraj)])
+    if len(last)==0:
+        return row
+    bound_cluster=int(np.bincount(last).argmax())
+    row["bound_cluster"]=bound_cluster
+    state_of=-np.ones(options["num_clus"], dtype=int)
+    state_of[states]=np.arange(len(states))
+    if state_of[bound_cluster]>=0:
+        times=mfpt(msm.transition_matrix, state_of[bound_cluster], tau=msm.lagtime)
+        start=state_of[first]
+        start=start[start>=0]
+        if len(start):
+            row["mfpt_to_bound"]=times[start].mean()
+    return row
+
+
+def main(args):
+    """
+    main function
+
+    1. Load the features of every cutoff once
+    2. Fit the clusters once for every (cutoff, number of clusters, seed), in parallel
+    3. Estimate the MSM of every combination with these clusters (lagtime, reversible), in parallel
+    4. Write one summary table with a line per combination
+    """
+    if os.path.exists(args.output_folder):
+        shutil.rmtree(args.output_folder)
+    os.mkdir(args.output_folder)
+
+    cuts=args.cut if args.cut is not None else [None]
+    # load (and cache) the features of every cutoff in the main process first:
+    # the workers then memory map them from the features cache
+    #and the hash of the features of every cutoff for the cache of the clusterings is computed once
+    digests={}
+    for cut in cuts:
+        folders=xyz_folders(args.folder_xyz, args.list_enc, cut)
+        features=get_features(folders, not args.no_feature_cache)[0]
+        if args.cluster_cache_size>0:
+            digests[tuple(folders)]=features_digest(features)
+
+    options={"use_cache":not args.no_feature_cache, "max_iter_kmeans":args.max_iter_kmeans, "clustering":args.clustering,
+             "batch_size":args.batch_size, "cluster_cache_size":args.cluster_cache_size, "digests":digests}
+    cluster_keys=list(itertools.product(cuts, args.num_clus, args.seed_kmeans))
+    print(f"Running {len(cluster_keys)} clusterings and {len(cluster_keys)*len(args.lagtime)*len(args.reversible)} MSMs")
+
+    with ProcessPoolExecutor(max_workers=args.n_jobs) as executor:
+        tasks=[(xyz_folders(args.folder_xyz, args.list_enc, cut), num_clus, seed, options) for cut,num_clus,seed in cluster_keys]
+        clusterings=dict(zip(cluster_keys, tqdm(executor.map(cluster_task, tasks), total=len(tasks), desc="clustering")))
+
+        combinations=[]
+        tasks=[]
+        for (cut,num_clus,seed),lagtime,reversible in itertools.product(cluster_keys, args.lagtime, args.reversible):
+            msm_options={"cut":cut, "num_clus":num_clus, "allow_disconnected":args.allow_disconnected, "sparse":args.sparse, "n_timescales":args.n_timescales}
+            combinations.append((cut, num_clus, seed, lagtime, reversible))
+            tasks.append((clusterings[(cut,num_clus,seed)][1], lagtime, reversible, msm_options))
+        rows=list(tqdm(executor.map(msm_task, tasks), total=len(tasks), desc="MSM"))
+
+    #cluster centers of every clustering, to build the selected MSM again or assign new trajectories
+    for (cut,num_clus,seed),(centers,dtrajs) in clusterings.items():
+        name=f"cluster_centers_k{num_clus}_seed{seed}" if cut is None else f"cluster_centers_cut{cut:g}_k{num_clus}_seed{seed}"
+        np.save(os.path.join(args.output_folder, name+".npy"), centers)
+
+    columns=["cut", "num_clus", "seed_kmeans", "lagtime", "reversible", "n_states", "connected_fraction"]
+    columns+=[f"timescale_{t+1}" for t in range(args.n_timescales)]+["bound_cluster", "mfpt_to_bound"]
+    with open(os.path.join(args.output_folder, "grid_summary.txt"), "w") as fout:
+        fout.write("# "+" ".join(columns)+"\n")
+        for (cut,num_clus,seed,lagtime,reversible),row in zip(combinations, rows):
+            values=["nan" if cut is None else f"{cut:g}", str(num_clus), str(seed), str(lagtime), str(reversible),
+                    str(row["n_states"]), f"{row['connected_fraction']:.3f}"]
+            values+=[f"{row[f'timescale_{t+1}']:.6g}" for t in range(args.n_timescales)]
+            values+=[str(row["bound_cluster"]), f"{row['mfpt_to_bound']:.6g}"]
+            fout.write(" ".join(values)+"\n")
+    print(f"Summary written in {args.output_folder}/grid_summary.txt")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Build the MSMs of a grid of parameters (cutoff, number of clusters, seed, lagtime, reversibility) "
+                                     "and write a summary table with one line per combination. The features are loaded once and the clusters "
+                                     "are fitted once for all the lagtimes and reversibility values", fromfile_prefix_chars="@",
+                                     epilog="Example usage:\n"
+                                     "python grid_MSM.py --folder_xyz folder_cut{cut}_trajectories --cut 30 50 --num_clus 5 8 --lagtime 1 2 4 --output_folder grid_folder --list_enc 84 159 190")
+    parser.add_argument("--folder_xyz", type=str, required=True, help="Prefix for folders which contains xyz files, with {cut} in place of the cutoff if --cut is provided")
+    parser.add_argument("--list_enc", nargs="+", required=True, help="List of integers to tell the code which are the folders with the encounter traj inside (or @file)")
+    parser.add_argument("--output_folder", type=str, required=True, help="Folder where to save the summary table, it exists, overwrite")
+    parser.add_argument("--cut", nargs="+", type=float, required=False, default=None, help="Cutoffs of the encounter trajectories (see Get_encounter_traj.py)")
+    parser.add_argument("--num_clus", nargs="+", type=int, required=True, help="Numbers of clusters")
+    parser.add_argument("--lagtime", nargs="+", type=int, required=False, default=[1], help="Lagtimes of the MSM")
+    parser.add_argument("--seed_kmeans", nargs="+", type=int, required=False, default=[13], help="KMeans seeds")
+    parser.add_argument("--reversible", nargs="+", type=str2bool, required=False, default=[False], help="Reversibility of the MSM, e.g. false true")
+    parser.add_argument("--max_iter_kmeans", type=int, required=False, default=500, help="Max iteration in KMeans cluster optimization")
+    parser.add_argument("--allow_disconnected", type=str2bool, required=False, default=False, help="If true, allow disconnected states in the MSM (not recommended)")
+    parser.add_argument("--clustering", type=str, required=False, default="kmeans", choices=CLUSTERING_METHODS, help="kmeans (default) or minibatch, as in build_MSM.py")
+    parser.add_argument("--batch_size", type=int, required=False, default=DEFAULT_BATCH_SIZE, help="Frames per mini-batch with --clustering minibatch")
+    parser.add_argument("--sparse", action="store_true", help="sparse MSMs, as in build_MSM.py")
+    parser.add_argument("--n_timescales", type=int, required=False, default=3, help="Number of leading implied timescales in the summary")
+    parser.add_argument("--n_jobs", type=int, required=False, default=os.cpu_count(), help="Number of processes, by default all the cores")
+    parser.add_argument("--cluster_cache_size", type=float, required=False, default=DEFAULT_CLUSTER_CACHE_SIZE, help="Size limit (MB) of the cache of the clusterings in .msm_cluster_cache, 0 to disable it")
+    parser.add_argument("--no_feature_cache", action="store_true", help="always read the xyz files and do not write the features cache")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,26 @@
+# load_dcd.tcl
+# Load the encounter trajectories written with --vmd_format dcd
+# (all the trajectories one after the other, see folder_trajectories_1_vmd_frames.txt)
+set prefix "./folder_trajectories_1_vmd"
+
+mol new $prefix.pdb type pdb
+set mol_id [molinfo top get id]
+mol addfile $prefix.dcd type dcd waitfor all molid $mol_id
+
+# Set CPK representation for the molecule
+mol representation CPK
+mol color Name
+mol selection all
+mol addrep $mol_id
+
+# cluster centers written with --single_centers_pdb by build_MSM.py / build_MSM_single_folder.py
+set clus_file "./folder_msm/cluster_centers.pdb"
+if {[file exists $clus_file]} {
+    mol new $clus_file type pdb
+    set mol_id [molinfo top get id]
+
+    mol representation CPK 3.0
+    mol color ColorID 3
+    mol selection all
+    mol addrep $mol_id
+}
@@ -0,0 +1,225 @@
+import os
+import numpy as np
+from scipy import sparse
+from deeptime.markov import TransitionCountEstimator, TransitionCountModel
+from deeptime.markov.msm import MaximumLikelihoodMSM, MarkovStateModel
+from deeptime.markov.tools.analysis import mfpt
+
+# Arrays of the MSM saved in the MSM folder next to the text files msm_rates and msm_mfpt:
+# transition_matrix, stationary_distribution, mfpt (mfpt[i, j] from state i to state j, or to
+# state mfpt_states[j] if only some target states are computed), lagtime, active_set (cluster of
+# every state). In sparse mode the transition matrix is saved in CSR format
+# (transition_matrix_data, _indices, _indptr, _shape) together with the leading timescales and
+# right eigenvectors
+MSM_ARRAYS_FILE = "msm_arrays.npz"
+
+# Transition counts of the MSM over all the clusters (CSR format: count_matrix_data, _indices, _indptr,
+# _shape), with the lagtime and the xyz folders already counted: the counts of new folders are added
+# to them to update the MSM without assigning the previous folders again (build_MSM.py --update)
+MSM_COUNTS_FILE = "msm_counts.npz"
+
+# Leading timescales computed in sparse mode
+DEFAULT_N_TIMESCALES = 10
+
+
+def estimate_msm(dtrajs, lagtime, reversible=False, allow_disconnected=False, sparse_mode=False, count_mode="sliding"):
+    """
+    Maximum likelihood MSM of discrete trajectories
+
+    In sparse mode the count matrix and the transition matrix are scipy sparse matrices, restricted
+    to the largest connected set of states (unless allow_disconnected): memory and time scale with
+    the number of observed transitions instead of the number of states squared.
+
+    Parameters:
+        dtrajs : list of discrete trajectories
+        lagtime : lagtime of the MSM
+        reversible : if True, MSM constrained to satisfy detailed balance
+        allow_disconnected : if True, allow disconnected states in the MSM
+        sparse_mode : if True, use sparse matrices
+        count_mode : counting of the transitions (sparse mode only, see TransitionCountEstimator)
+
+    Returns:
+        deeptime MarkovStateModel
+    """
+    if not sparse_mode:
+        return MaximumLikelihoodMSM(lagtime=lagtime, reversible=reversible, allow_disconnected=allow_disconnected).fit_fetch(dtrajs)
+    # the counts are built explicitly: fitting the MSM on the trajectories gives dense matrices
+    counts = TransitionCountEstimator(lagtime=lagtime, count_mode=count_mode, sparse=True).fit(dtrajs).fetch_model()
+    if not allow_disconnected:
+        counts = counts.submodel_largest()
+    return MaximumLikelihoodMSM(reversible=reversible, allow_disconnected=allow_disconnected, sparse=True).fit(counts).fetch_model()
+
+
+def count_transitions(dtrajs, lagtime, n_states, count_mode="sliding"):
+    """
+    Transition count matrix of discrete trajectories over all the clusters, also the ones not
+    visited: the count matrices of different sets of trajectories can be summed
+
+    Parameters:
+        dtrajs : list of discrete trajectories
+        lagtime : lagtime of the MSM
+        n_states : number of clusters
+        count_mode : counting of the transitions (see TransitionCountEstimator)
+
+    Returns:
+        scipy CSR matrix of shape (n_states, n_states)
+    """
+    counts = TransitionCountEstimator(lagtime=lagtime, count_mode=count_mode, n_states=n_states, sparse=True).fit(dtrajs).fetch_model()
+    return sparse.csr_matrix(counts.count_matrix)
+
+
+def estimate_msm_from_counts(count_matrix, lagtime, reversible=False, allow_disconnected=False, sparse_mode=False, count_mode="sliding"):
+    """
+    Maximum likelihood MSM of a transition count matrix (see count_transitions), the same
+    MSM as estimate_msm of the trajectories counted
+
+    Parameters:
+        count_matrix : count matrix, numpy array or scipy sparse matrix
+        lagtime : lagtime of the counts
+        reversible, allow_disconnected, sparse_mode : see estimate_msm
+        count_mode : counting of the transitions
+
+    Returns:
+        deeptime MarkovStateModel
+    """
+    if not sparse_mode and sparse.issparse(count_matrix):
+        count_matrix = count_matrix.toarray()
+    counts = TransitionCountModel(count_matrix, counting_mode=count_mode, lagtime=lagtime)
+    if sparse_mode and not allow_disconnected:
+        counts = counts.submodel_largest()
+    return MaximumLikelihoodMSM(reversible=reversible, allow_disconnected=allow_disconnected, sparse=sparse_mode).fit(counts).fetch_model()
+
+
+def leading_eigenpairs(msm, k=DEFAULT_N_TIMESCALES):
+    """
+    Leading implied timescales and right eigenvectors of an MSM. For a sparse transition
+    matrix only these are computed, with an iterative (Arnoldi) solver.
+
+    Parameters:
+        msm : deeptime MarkovStateModel
+        k : number of timescales
+
+    Returns:
+        timescales : shape (k,)
+        eigenvectors : right eigenvectors, shape (n_states, k + 1), the first one is constant
+    """
+    k = min(k, msm.n_states - 1)
+    # the iterative solver needs less eigenvalues (k + 1) than states - 1: a small connected set is solved dense
+    if sparse.issparse(msm.transition_matrix) and k + 1 >= msm.n_states - 1:
+        msm = MarkovStateModel(msm.transition_matrix.toarray(), lagtime=msm.lagtime)
+    return np.asarray(msm.timescales(k)), np.asarray(msm.eigenvectors_right(k + 1))
+
+
+def active_set(msm):
+    """
+    Cluster of every state of an MSM (the MSM can be restricted to a connected set)
+    """
+    if msm.count_model is None:
+        return np.arange(msm.n_states)
+    return np.asarray(msm.count_model.state_symbols)
+
+
+def mfpt_matrix(msm, targets=None):
+    """
+    Mean first passage times of an MSM from all the states to some target states (all the
+    pairs of states by default), with one linear solve per target state (all the starting
+    states at once) instead of one per pair. Same values as msm.mfpt(i, j). The transition
+    matrix can be sparse (sparse solver).
+
+    Parameters:
+        msm : deeptime MarkovStateModel
+        targets : target states, all the states if None
+
+    Returns:
+        numpy array of shape (n_states, n_targets), element [i, t] is the mfpt from i to
+        targets[t], in units of the input trajectory time step
+    """
+    n_states = msm.n_states
+    targets = np.arange(n_states) if targets is None else np.asarray(targets, dtype=int)
+    stationary = msm.stationary_distribution
+    times = np.empty((n_states, len(targets)))
+    for t, j in enumerate(targets):
+        times[:, t] = mfpt(msm.transition_matrix, j, tau=msm.lagtime)
+    # from a state of null stationary probability the mfpt is not defined (msm.mfpt gives nan)
+    times[stationary == 0, :] = np.nan
+    return times
+
+
+def write_msm_arrays(folder_msm, msm, times=None, n_timescales=DEFAULT_N_TIMESCALES, mfpt_states=None):
+    """
+    Writes the transition matrix, the stationary distribution and the mfpt matrix of an MSM
+    in folder_msm/MSM_ARRAYS_FILE
+
+    Parameters:
+        folder_msm : output folder of the MSM
+        msm : deeptime MarkovStateModel
+        times : mfpt matrix (see mfpt_matrix), if computed
+        n_timescales : number of leading timescales and eigenvectors saved, sparse mode only
+        mfpt_states : target states of the columns of times, if not all the states
+    """
+    arrays = {"stationary_distribution": np.asarray(msm.stationary_distribution), "lagtime": msm.lagtime,
+              "active_set": active_set(msm)}
+    if times is not None:
+        arrays["mfpt"] = times
+        if mfpt_states is not None:
+            arrays["mfpt_states"] = np.asarray(mfpt_states, dtype=int)
+    if sparse.issparse(msm.transition_matrix):
+        transition_matrix = sparse.csr_matrix(msm.transition_matrix)
+        arrays.update(transition_matrix_data=transition_matrix.data, transition_matrix_indices=transition_matrix.indices,
+                      transition_matrix_indptr=transition_matrix.indptr, transition_matrix_shape=np.array(transition_matrix.shape))
+        arrays["timescales"], arrays["eigenvectors"] = leading_eigenpairs(msm, n_timescales)
+    else:
+        arrays["transition_matrix"] = np.asarray(msm.transition_matrix)
+    np.savez(os.path.join(folder_msm, MSM_ARRAYS_FILE), **arrays)
+
+
+def load_msm_arrays(folder_msm):
+    """
+    Reads the arrays written by write_msm_arrays
+
+    Parameters:
+        folder_msm : output folder of the MSM
+
+    Returns:
+        dictionary with transition_matrix (scipy CSR matrix in sparse mode), stationary_distribution,
+        mfpt (and mfpt_states) if computed, lagtime, active_set, and in sparse mode timescales and
+        eigenvectors
+    """
+    with np.load(os.path.join(folder_msm, MSM_ARRAYS_FILE)) as arrays:
+        arrays = {key: arrays[key] for key in arrays.files}
+    if "transition_matrix_data" in arrays:
+        arrays["transition_matrix"] = sparse.csr_matrix((arrays.pop("transition_matrix_data"), arrays.pop("transition_matrix_indices"),
+                                                         arrays.pop("transition_matrix_indptr")), shape=tuple(arrays.pop("transition_matrix_shape")))
+    return arrays
+
+
+def write_msm_counts(folder_msm, count_matrix, lagtime, folders):
+    """
+    Writes the transition counts of an MSM in folder_msm/MSM_COUNTS_FILE
+
+    Parameters:
+        folder_msm : output folder of the MSM
+        count_matrix : count matrix over all the clusters (see count_transitions)
+        lagtime : lagtime of the counts
+        folders : xyz folders counted
+    """
+    count_matrix = sparse.csr_matrix(count_matrix)
+    np.savez(os.path.join(folder_msm, MSM_COUNTS_FILE), count_matrix_data=count_matrix.data, count_matrix_indices=count_matrix.indices,
+             count_matrix_indptr=count_matrix.indptr, count_matrix_shape=np.array(count_matrix.shape), lagtime=lagtime,
+             folders=np.array(folders, dtype=str))
+
+
+def load_msm_counts(folder_msm):
+    """
+    Reads the counts written by write_msm_counts
+
+    Parameters:
+        folder_msm : output folder of the MSM
+
+    Returns:
+        dictionary with count_matrix (scipy CSR matrix), lagtime and folders (list)
+    """
+    with np.load(os.path.join(folder_msm, MSM_COUNTS_FILE)) as counts:
+        count_matrix = sparse.csr_matrix((counts["count_matrix_data"], counts["count_matrix_indices"], counts["count_matrix_indptr"]),
+                                         shape=tuple(counts["count_matrix_shape"]))
+        return {"count_matrix": count_matrix, "lagtime": int(counts["lagtime"]), "folders": counts["folders"].tolist()}
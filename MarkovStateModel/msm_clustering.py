@@ -0,0 +1,252 @@
+import os
+import json
+import hashlib
+import numpy as np
+from scipy.spatial import cKDTree
+from deeptime.clustering import KMeans, MiniBatchKMeans, KMeansModel
+
+# kmeans    : deeptime KMeans over all the frames (kmeans++ or uniform initial centers, then
+#             Lloyd iterations until convergence or max_iter)
+# minibatch : initial centers from a random sample of the frames, then max_iter updates of the
+#             centers, each one with a random mini-batch of frames: only the sampled frames of
+#             the (memory mapped) features are read, never the whole array at once
+CLUSTERING_METHODS = ["kmeans", "minibatch"]
+
+# Frames per mini-batch, and frames assigned to the cluster centers at a time
+DEFAULT_BATCH_SIZE = 10000
+DEFAULT_ASSIGN_CHUNK = 1000000
+
+# Cluster centers saved in the MSM folder, to assign new trajectories without fitting again
+CENTERS_FILE = "cluster_centers.npy"
+
+# Clusterings (centers, inertias and cluster of every frame) of the previous runs, one file per
+# clustering named after the hash of the features and of the clustering parameters, in the
+# folder where the scripts run. When the folder is larger than its size limit (MB) the least
+# recently used clusterings are removed.
+CLUSTER_CACHE_DIR = ".msm_cluster_cache"
+DEFAULT_CLUSTER_CACHE_SIZE = 2048
+
+
+def _sample_frames(features, size, rng):
+    """
+    Random frames of the features, read in file order
+    """
+    n_frames = len(features)
+    indexes = rng.choice(n_frames, size=size, replace=size > n_frames)
+    return np.asarray(features[np.sort(indexes)], dtype=np.float64)
+
+
+def fit_clusters(features, n_clusters, seed, max_iter, init_strategy="kmeans++", method="kmeans", batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Fits the cluster centers of the MSM discretization
+
+    Parameters:
+        features : numpy array of shape (n_frames, 3), can be memory mapped (see load_features)
+        n_clusters : number of clusters
+        seed : seed of the initial centers (and of the mini-batches)
+        max_iter : max number of KMeans iterations (number of mini-batches for minibatch)
+        init_strategy : "kmeans++" or "uniform"
+        method : one of CLUSTERING_METHODS
+        batch_size : frames per mini-batch (minibatch only)
+
+    Returns:
+        deeptime KMeansModel with the cluster centers and the inertia of every iteration
+    """
+    if method == "kmeans":
+        # place the centers first, then optimize them
+        estimator = KMeans(n_clusters=n_clusters, init_strategy=init_strategy, max_iter=0, fixed_seed=seed)
+        clustering = estimator.fit(features).fetch_model()
+        estimator.initial_centers = clustering.cluster_centers
+        estimator.max_iter = max_iter
+        return estimator.fit(features).fetch_model()
+
+    if method != "minibatch":
+        raise ValueError(f"Unknown clustering method {method}, expected one of {CLUSTERING_METHODS}")
+    rng = np.random.default_rng(seed)
+    # initial centers placed on a sample of a few mini-batches
+    sample = _sample_frames(features, min(len(features), max(batch_size, 10 * n_clusters)), rng)
+    initial = KMeans(n_clusters=n_clusters, init_strategy=init_strategy, max_iter=0, fixed_seed=seed).fit(sample).fetch_model()
+
+    estimator = MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size, initial_centers=initial.cluster_centers)
+    for _ in range(max_iter):
+        estimator.partial_fit(_sample_frames(features, batch_size, rng))
+        if estimator.fetch_model().converged:
+            break
+    model = estimator.fetch_model()
+    # the first inertia is a placeholder (inf) before the first mini-batch
+    return KMeansModel(cluster_centers=model.cluster_centers, metric=model.metric, tolerance=model.tolerance,
+                       inertias=model.inertias[1:], converged=model.converged)
+
+
+def assign_clusters(centers, features, chunk_size=DEFAULT_ASSIGN_CHUNK, n_jobs=-1):
+    """
+    Assigns every frame to its closest cluster center. The centers are indexed in a k-d tree,
+    queried a chunk of frames at a time by n_jobs threads: the same assignment as the brute
+    force KMeansModel.transform, in O(log n_clusters) per frame.
+
+    Parameters:
+        centers : cluster centers, shape (n_clusters, 3), or a KMeansModel (see fit_clusters)
+        features : numpy array of shape (n_frames, 3), can be memory mapped
+        chunk_size : frames assigned at a time
+        n_jobs : number of threads, -1 for all the cores
+
+    Returns:
+        numpy array with the cluster of every frame
+    """
+    if isinstance(centers, KMeansModel):
+        centers = centers.cluster_centers
+    tree = cKDTree(np.asarray(centers, dtype=np.float64).reshape(len(centers), -1))
+    dtraj = np.empty(len(features), dtype=np.int32)
+    for start in range(0, len(features), chunk_size):
+        chunk = np.asarray(features[start:start + chunk_size], dtype=np.float64)
+        dtraj[start:start + chunk_size] = tree.query(chunk, k=1, workers=n_jobs)[1]
+    return dtraj
+
+
+def wcss(centers, features, dtraj, chunk_size=DEFAULT_ASSIGN_CHUNK):
+    """
+    Within-cluster sum of squares of a clustering: mean squared distance of the frames from
+    their cluster center, and the standard deviation of the squared distances
+
+    Parameters:
+        centers : cluster centers, shape (n_clusters, 3)
+        features : numpy array of shape (n_frames, 3), can be memory mapped
+        dtraj : cluster of every frame (see assign_clusters)
+        chunk_size : frames read at a time
+
+    Returns:
+        wcss, wcss standard deviation
+    """
+    centers = np.asarray(centers, dtype=np.float64)
+    squared = np.empty(len(features))
+    for start in range(0, len(features), chunk_size):
+        chunk = np.asarray(features[start:start + chunk_size], dtype=np.float64)
+        squared[start:start + chunk_size] = np.sum((chunk - centers[dtraj[start:start + chunk_size]]) ** 2, axis=1)
+    return squared.mean(), squared.std()
+
+
+def save_centers(folder_msm, centers):
+    """
+    Saves the cluster centers in folder_msm/CENTERS_FILE
+
+    Parameters:
+        folder_msm : output folder of the MSM
+        centers : cluster centers, shape (n_clusters, 3)
+    """
+    np.save(os.path.join(folder_msm, CENTERS_FILE), np.asarray(centers, dtype=np.float64))
+
+
+def load_centers(path):
+    """
+    Reads the cluster centers saved by save_centers
+
+    Parameters:
+        path : MSM folder, or the centers file
+
+    Returns:
+        cluster centers, shape (n_clusters, 3)
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, CENTERS_FILE)
+    return np.load(path)
+
+
+def features_digest(features, chunk_size=DEFAULT_ASSIGN_CHUNK):
+    """
+    Hash of the content of the features, read a chunk of frames at a time
+
+    Parameters:
+        features : numpy array of shape (n_frames, 3), can be memory mapped
+
+    Returns:
+        hexadecimal string
+    """
+    digest = hashlib.sha256(str(np.shape(features)).encode())
+    for start in range(0, len(features), chunk_size):
+        digest.update(np.ascontiguousarray(features[start:start + chunk_size], dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def _cache_file(cache_dir, digest, parameters):
+    """
+    File of a clustering in the cache: hash of the features and of the clustering parameters
+    """
+    key = hashlib.sha256((digest + json.dumps(parameters, sort_keys=True)).encode()).hexdigest()
+    return os.path.join(cache_dir, key + ".npz")
+
+
+def _evict(cache_dir, max_size):
+    """
+    Removes the least recently used clusterings until the cache is smaller than max_size (MB)
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".npz"):
+            try:
+                stat = os.stat(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_size * 1024**2:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def cached_clustering(features, n_clusters, seed, max_iter, init_strategy="kmeans++", method="kmeans", batch_size=DEFAULT_BATCH_SIZE,
+                      n_jobs=-1, cache_dir=CLUSTER_CACHE_DIR, max_size=DEFAULT_CLUSTER_CACHE_SIZE, digest=None):
+    """
+    Fits the clusters (see fit_clusters) and assigns all the frames (see assign_clusters), or reads
+    both from the cache when the same features have already been clustered with the same parameters
+    (e.g. a new MSM with a different lagtime)
+
+    Parameters:
+        features : numpy array of shape (n_frames, 3), can be memory mapped
+        n_clusters, seed, max_iter, init_strategy, method, batch_size : see fit_clusters
+        n_jobs : number of threads of the assignment
+        cache_dir : folder of the cache
+        max_size : size limit of the cache in MB, 0 to disable the cache
+        digest : hash of the features (see features_digest), computed if not provided
+
+    Returns:
+        KMeansModel and cluster of every frame
+    """
+    if max_size <= 0:
+        model = fit_clusters(features, n_clusters, seed, max_iter, init_strategy=init_strategy, method=method, batch_size=batch_size)
+        return model, assign_clusters(model, features, n_jobs=n_jobs)
+
+    parameters = {"n_clusters": n_clusters, "seed": seed, "max_iter": max_iter, "init_strategy": init_strategy, "method": method}
+    if method == "minibatch":
+        parameters["batch_size"] = batch_size
+    path = _cache_file(cache_dir, digest or features_digest(features), parameters)
+    try:
+        with np.load(path) as cached:
+            model = KMeansModel(cluster_centers=cached["cluster_centers"], metric="euclidean", tolerance=float(cached["tolerance"]),
+                                inertias=cached["inertias"], converged=bool(cached["converged"]))
+            dtraj = cached["dtraj"]
+        # last use, for the eviction
+        os.utime(path)
+        return model, dtraj
+    except (OSError, ValueError, KeyError):
+        pass
+
+    model = fit_clusters(features, n_clusters, seed, max_iter, init_strategy=init_strategy, method=method, batch_size=batch_size)
+    dtraj = assign_clusters(model, features, n_jobs=n_jobs)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a temporary file first so that a killed (or parallel) job never leaves a broken file
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as fout:
+            np.savez(fout, cluster_centers=model.cluster_centers, inertias=np.asarray(model.inertias), dtraj=dtraj,
+                     tolerance=model.tolerance, converged=model.converged)
+        os.replace(tmp, path)
+        _evict(cache_dir, max_size)
+    except OSError:
+        # read only folder, work without cache
+        pass
+    return model, dtraj
@@ -0,0 +1,268 @@
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tools"))
+from sda_geometry import pbc_distance, pbc_delta, rotation_matrices, rotate_back, to_sda_frame
+from sda_trajectory import parse_lines, coordinates, previous_row, open_file, HEADER_LINES
+
+
+# Character columns of t (x, y, z), r1 (x, y, z) and r2 (x, y, z) in the lines of an sda
+# trajectory file, and their widths
+SDA_COLUMNS = [(26, 33), (35, 42), (44, 51), (54, 60), (63, 69), (72, 78), (81, 87), (90, 96), (99, 105)]
+SDA_WIDTHS = [end - start for start, end in SDA_COLUMNS]
+
+
+def read_complexes(path):
+    """
+    Reads the encounter complexes file (fcomplexes) of sda
+
+    The first complex of every run is the first frame where the run is close to the
+    active state. The first run is skipped, as well as the complexes at frame 0: the
+    starting point of the first trajectory is not on the b-surface and might be biased.
+
+    Parameters:
+        path : complexes file (can be compressed)
+
+    Returns:
+        first_frames : dictionary run -> first encounter frame
+        complexes_lines : dictionary run -> (p1 line, p2 line) of the first encounter complex
+    """
+    with open_file(path, "r") as fin:
+        lines = fin.readlines()[HEADER_LINES:]
+    complexes = parse_lines("".join(lines))
+
+    first_frames = {}
+    complexes_lines = {}
+    prev_sim = 0
+    for l, (run, frame) in enumerate(zip(complexes["run"].tolist(), complexes["frame"].tolist())):
+        # a line of the same run as the previous one is a continuation: the bound state is already found
+        if run != prev_sim and frame != 0:
+            prev_sim = run
+            first_frames[run] = frame
+            complexes_lines[run] = (lines[l], lines[l + 1])
+    return first_frames, complexes_lines
+
+
+def com_distances(records, box_size):
+    """
+    Minimum image distance between the protein (solute 1) and the ligand (the line after
+    the protein) of the frame of every record
+
+    Parameters:
+        records : records array
+        box_size : box length
+
+    Returns:
+        numpy array with one distance per record (0 before the first protein line)
+    """
+    if len(records) == 0:
+        return np.zeros(0)
+    positions = coordinates(records, "t")
+    p1_rows = previous_row(records, 1)
+    lig_rows = np.minimum(p1_rows + 1, len(records) - 1)
+    return np.where(p1_rows >= 0, pbc_distance(positions[lig_rows], positions[p1_rows], box_size), 0.0)
+
+
+def encounter_folder(ftrajectories, cut=None):
+    """
+    Folder of the encounter trajectories extracted from a trajectory file
+
+    Parameters:
+        ftrajectories : name of the trajectory file (ftrajectories in the sda input file)
+        cut : cutoff of the com-com distance, when the trajectories are extracted for several cutoffs
+
+    Returns:
+        folder_ftrajectories, or folder_cut<cut>_ftrajectories if cut is provided
+    """
+    if cut is None:
+        return f"folder_{ftrajectories}"
+    return f"folder_cut{cut:g}_{ftrajectories}"
+
+
+def encounter_segments(records, first_frames, cuts, box_size):
+    """
+    Finds the encounter trajectory of every run: the protein and ligand lines preceding the
+    first encounter frame, going back in time until the com-com distance is over the cutoff.
+    Frames where the ligand has reached the protein in the "wrong" place and gone away
+    before finding the pocket are discarded this way.
+    The distances are computed once and all the cutoffs are applied to them.
+
+    Parameters:
+        records : records array of one or more whole runs, in file order
+        first_frames : dictionary run -> first encounter frame (see read_complexes)
+        cuts : list of cutoffs of the com-com distance
+        box_size : box length
+
+    Returns:
+        dictionary cut -> dictionary run -> indexes of the records of the segment. Runs which
+        do not go past their first encounter frame in records are not included.
+    """
+    segments = {cut: {} for cut in cuts}
+    keep = np.flatnonzero(records["solute"] <= 2)
+    if len(keep) == 0:
+        return segments
+    dists = com_distances(records, box_size)[keep]
+    runs = records["run"][keep]
+    frames = records["frame"][keep]
+
+    # blocks of consecutive lines of the same run
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(runs)) + 1))
+    ends = np.append(starts[1:], len(runs))
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        run = int(runs[start])
+        if run not in first_frames:
+            continue
+        after = np.flatnonzero(frames[start:end] > first_frames[run])
+        if len(after) == 0:
+            continue
+        # the segment ends at the first line after the encounter frame, and starts after the
+        # last line (this one included) where the two coms are over the cutoff
+        last = start + after[0]
+        for cut in cuts:
+            breaks = np.flatnonzero(dists[start:last + 1] > cut)
+            first = start + breaks[-1] + 1 if len(breaks) else start
+            segments[cut][run] = keep[first:last]
+    return segments
+
+
+def align_to_p1(records, box_size):
+    """
+    Orientation and position of every record in the reference system of the p1 of its frame
+
+    Parameters:
+        records : records array with whole frames (p1 line first)
+        box_size : box length
+
+    Returns:
+        alligned_R : rotation of p1 in its own reference system, shape (N, 3, 3)
+        delta_vec_rotated : translation relative to p1, in the reference system of p1, shape (N, 3)
+        new_R : rotation in the reference system of p1 (rows r1, r2, r3), shape (N, 3, 3)
+    """
+    R = rotation_matrices(coordinates(records, "r1"), coordinates(records, "r2"))
+    translations = coordinates(records, "t")
+    p1_rows = previous_row(records, 1)
+    RP = R[p1_rows]
+    alligned_R = np.matmul(RP.transpose(0, 2, 1), RP)
+    delta_vec_rotated = rotate_back(RP, pbc_delta(translations, translations[p1_rows], box_size))
+    new_R = np.matmul(RP.transpose(0, 2, 1), R).transpose(0, 2, 1)
+    return alligned_R, delta_vec_rotated, new_R
+
+
+def format_fields(lines, values):
+    """
+    Writes new values in the fixed-width columns of sda trajectory lines (see SDA_COLUMNS),
+    as '{0:.3f}'.format(value).rjust(width). All the other characters are kept as they are.
+
+    The values are formatted all at once. When all the lines have the same length and every
+    value fits in its column (the usual case), the columns are copied into a byte matrix of
+    the lines instead of building the lines one by one.
+
+    Parameters:
+        lines : list of sda trajectory lines
+        values : numpy array of shape (len(lines), 9) with the new t, r1 and r2
+
+    Returns:
+        list with the new lines
+    """
+    if len(lines) == 0:
+        return []
+    fields = [np.char.mod(f"%{width}.3f", values[:, i]) for i, width in enumerate(SDA_WIDTHS)]
+
+    text = "".join(lines)
+    encoded = text.encode()
+    line_length = len(lines[0])
+    bulk = (len(encoded) == len(text) == line_length * len(lines) and line_length > SDA_COLUMNS[-1][1]
+            and all(len(line) == line_length for line in lines)
+            and all((np.char.str_len(field) == width).all() for field, width in zip(fields, SDA_WIDTHS)))
+    if bulk:
+        matrix = np.frombuffer(encoded, dtype=np.uint8).reshape(len(lines), line_length).copy()
+        for field, (start, end) in zip(fields, SDA_COLUMNS):
+            matrix[:, start:end] = np.frombuffer(field.astype(f"S{end - start}").tobytes(), dtype=np.uint8).reshape(-1, end - start)
+        new_text = matrix.tobytes().decode()
+        return [new_text[i:i + line_length] for i in range(0, len(new_text), line_length)]
+
+    # values wider than their column or lines of different lengths: line by line
+    fields = [field.tolist() for field in fields]
+    new_lines = []
+    for l, line in enumerate(lines):
+        new_line = line[:SDA_COLUMNS[0][0]]
+        for i, (start, end) in enumerate(SDA_COLUMNS):
+            following = SDA_COLUMNS[i + 1][0] if i + 1 < len(SDA_COLUMNS) else None
+            new_line += fields[i][l] + line[end:following]
+        new_lines.append(new_line)
+    return new_lines
+
+
+def center_sda_lines(lines, records, box_size, com_p1):
+    """
+    Rewrites sda trajectory lines in the reference system of p1, centered on com_p1:
+    p1 lines get a null translation, p2 lines the translation and rotation relative to p1.
+    Crowder lines are dropped. All the other columns are kept as they are.
+
+    Parameters:
+        lines : trajectory lines (no header)
+        records : records of the lines
+        box_size : box length
+        com_p1 : center of mass of p1, shape (3,)
+
+    Returns:
+        list with the new lines
+    """
+    alligned_R, delta_vec_rotated, newR = align_to_p1(records, box_size)
+    delta_vec_rotated = delta_vec_rotated + com_p1
+
+    # p1: no translation and its rotation in its own reference system,
+    # p2: translation and rotation in the reference system of p1
+    is_p1 = (records["solute"] == 1)[:, None]
+    values = np.where(is_p1,
+                      np.concatenate((np.zeros_like(delta_vec_rotated), alligned_R[:, 0], alligned_R[:, 1]), axis=1),
+                      np.concatenate((delta_vec_rotated, newR[:, 0], newR[:, 1]), axis=1))
+
+    rows = np.flatnonzero(records["solute"] <= 2).tolist()
+    return format_fields([lines[l] for l in rows], values[rows])
+
+
+def ligand_positions(records, body_xyz, box_size):
+    """
+    Positions of the ligand (solute 2) in the reference system of the p1 of its frame
+
+    Parameters:
+        records : records array with whole frames (p1 line first)
+        body_xyz : positions relative to the ligand center of mass, shape (n_atoms, 3); the
+                   mean of the atoms (shape (1, 3)) gives the ligand center directly
+        box_size : box length
+
+    Returns:
+        lig_rows : indexes of the ligand records
+        numpy array of shape (n_ligand_records, n_atoms, 3)
+    """
+    p1_rows = previous_row(records, 1)
+    lig_rows = np.flatnonzero(records["solute"] == 2)
+    lig_lines = records[lig_rows]
+    p1_lines = records[p1_rows[lig_rows]]
+
+    # ligand in the sda frame, relative to p1, then brought in the p1 reference system
+    RP = rotation_matrices(coordinates(p1_lines, "r1"), coordinates(p1_lines, "r2"))
+    Rl = rotation_matrices(coordinates(lig_lines, "r1"), coordinates(lig_lines, "r2"))
+    delta_vec = pbc_delta(coordinates(lig_lines, "t"), coordinates(p1_lines, "t"), box_size)
+    return lig_rows, rotate_back(RP, to_sda_frame(body_xyz, Rl, delta_vec))
+
+
+def xyz_lines(centers, p1_com):
+    """
+    Lines of an xyz encounter trajectory file
+
+    Parameters:
+        centers : ligand centers in the reference system of p1, shape (N, 3)
+        p1_com : center of mass of p1, shape (3,)
+
+    Returns:
+        list with one line per frame
+    """
+    new_lines = []
+    for new_com_lig in centers:
+        xsim = '{0:.3f}'.format(new_com_lig[0] + p1_com[0]).rjust(7)
+        ysim = '{0:.3f}'.format(new_com_lig[1] + p1_com[1]).rjust(7)
+        zsim = '{0:.3f}'.format(new_com_lig[2] + p1_com[2]).rjust(7)
+        new_lines.append(xsim + " " + ysim + " " + zsim + "\n")
+    return new_lines
@@ -0,0 +1,228 @@
+import io
+import os
+import json
+import shutil
+import numpy as np
+
+# A segment store keeps all the encounter trajectories of a folder (e.g. folder_trajectories_1,
+# folder_trajectories_1_xyz) in a single file folder_trajectories_1.npz instead of one small
+# file per trajectory:
+# data    : all the segments one after the other, either the bytes of the sda lines or an
+#           array of coordinates
+# offsets : segment i is data[offsets[i]:offsets[i+1]]
+# runs    : run number (in the source trajectory file) of every segment
+# header  : the header lines of the sda trajectory files, for text segments
+# kind    : "text" or "array"
+STORE_SUFFIX = ".npz"
+
+# The features of the MSM scripts (all the xyz frames of a folder, or of its store, in a single
+# (N, 3) array) are cached next to the folder in folder_xyz.features.npy, memory mapped by the
+# following runs, with the offsets of the trajectories and the signature of the sources in
+# folder_xyz.features.json
+FEATURES_SUFFIX = ".features"
+
+
+def store_path(folder):
+    """
+    Name of the segment store replacing a folder of encounter trajectories
+
+    Parameters:
+        folder : folder name (e.g. folder_trajectories_1_xyz)
+
+    Returns:
+        folder name + STORE_SUFFIX
+    """
+    return folder.rstrip("/") + STORE_SUFFIX
+
+
+def remove_output(folder):
+    """
+    Removes the previous outputs of a stage, both as a folder and as a segment store
+
+    Parameters:
+        folder : folder name
+    """
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    if os.path.exists(store_path(folder)):
+        os.remove(store_path(folder))
+
+
+def write_store(path, segments, runs=None, header="", compress=False):
+    """
+    Writes a list of segments into a single store file
+
+    Parameters:
+        path : store file name (see store_path)
+        segments : list of str (sda lines of every segment, without header) or list of numpy arrays
+        runs : run number of every segment, by default 1, 2, ...
+        header : header lines of the sda files
+        compress : if True, the store is compressed (zip deflate)
+    """
+    text = len(segments) > 0 and isinstance(segments[0], str)
+    if text:
+        encoded = [segment.encode() for segment in segments]
+        data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        lengths = [len(segment) for segment in encoded]
+    else:
+        data = np.concatenate(segments) if len(segments) else np.zeros((0, 3))
+        lengths = [len(segment) for segment in segments]
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+    if runs is None:
+        runs = np.arange(1, len(segments) + 1)
+
+    save = np.savez_compressed if compress else np.savez
+    with open(path, "wb") as fout:
+        save(fout, data=data, offsets=offsets, runs=np.asarray(runs, dtype=np.int64),
+             header=np.array(header), kind=np.array("text" if text else "array"))
+
+
+def load_store(path):
+    """
+    Reads all the segments of a store file
+
+    Parameters:
+        path : store file name
+
+    Returns:
+        segments : list of str (text store) or list of numpy arrays
+        metadata : dictionary with the runs of the segments and the header lines
+    """
+    with np.load(path) as store:
+        data = store["data"]
+        offsets = store["offsets"].tolist()
+        kind = str(store["kind"])
+        metadata = {"runs": store["runs"], "header": str(store["header"])}
+    if kind == "text":
+        segments = [data[start:end].tobytes().decode() for start, end in zip(offsets[:-1], offsets[1:])]
+    else:
+        segments = [data[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+    return segments, metadata
+
+
+def segment_lines(segment, header=""):
+    """
+    Lines of a text segment, as readlines() of the corresponding sda file would return them
+
+    Parameters:
+        segment : text of the segment
+        header : header lines
+
+    Returns:
+        list of lines
+    """
+    return io.StringIO(header + segment).readlines()
+
+
+def load_xyz_segments(folder, name_filter=None):
+    """
+    Reads the xyz encounter trajectories of a folder, from its segment store if there is one
+
+    Parameters:
+        folder : folder of the xyz files (e.g. folder_trajectories_1_xyz)
+        name_filter : if provided, only files with this string in the name are read (folder only)
+
+    Returns:
+        list of numpy arrays of shape (n_frames, 3)
+    """
+    if os.path.exists(store_path(folder)):
+        return load_store(store_path(folder))[0]
+    data = []
+    for file in os.listdir(folder):
+        if name_filter is None or name_filter in file:
+            data.append(np.loadtxt(f"{folder}/{file}"))
+    return data
+
+
+def _features_signature(folder, name_filter):
+    """
+    Files the features of a folder are read from, in reading order, with their size and
+    modification time: the cache is valid as long as they do not change
+    """
+    if os.path.exists(store_path(folder)):
+        files = [store_path(folder)]
+    else:
+        files = [f"{folder}/{file}" for file in os.listdir(folder) if name_filter is None or name_filter in file]
+    signature = []
+    for file in files:
+        stat = os.stat(file)
+        signature.append([os.path.basename(file), stat.st_size, stat.st_mtime_ns])
+    return signature
+
+
+def _load_folder_features(folder, name_filter, use_cache):
+    """
+    Features of a single folder, through its cache
+    """
+    folder = folder.rstrip("/")
+    npy_file, json_file = folder + FEATURES_SUFFIX + ".npy", folder + FEATURES_SUFFIX + ".json"
+    signature = _features_signature(folder, name_filter)
+    if use_cache:
+        try:
+            with open(json_file, "r") as fin:
+                metadata = json.load(fin)
+            # same files, in any order of the listing
+            if sorted(metadata["signature"]) == sorted(signature) and metadata["name_filter"] == name_filter:
+                return np.load(npy_file, mmap_mode="r"), np.asarray(metadata["offsets"], dtype=np.int64)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    segments = [np.asarray(segment, dtype=np.float64).reshape(-1, 3) for segment in load_xyz_segments(folder, name_filter=name_filter)]
+    features = np.concatenate(segments) if segments else np.zeros((0, 3))
+    offsets = np.concatenate(([0], np.cumsum([len(segment) for segment in segments]))).astype(np.int64)
+    if not use_cache:
+        return features, offsets
+
+    try:
+        # write to temporary files first so that a killed job never leaves a broken cache
+        with open(npy_file + ".tmp", "wb") as fout:
+            np.save(fout, features)
+        with open(json_file + ".tmp", "w") as fout:
+            json.dump({"signature": signature, "name_filter": name_filter, "offsets": offsets.tolist()}, fout)
+        os.replace(npy_file + ".tmp", npy_file)
+        os.replace(json_file + ".tmp", json_file)
+    except OSError:
+        # read only folder, work without cache
+        return features, offsets
+    return np.load(npy_file, mmap_mode="r"), offsets
+
+
+def load_features(folders, name_filter=None, use_cache=True):
+    """
+    Loads the xyz encounter trajectories of one or more folders (or segment stores) as a single
+    array, the input of the clustering. The text files are read only the first time: the array
+    is cached next to every folder and memory mapped by the following calls, until a file of
+    the folder changes.
+
+    Parameters:
+        folders : folder of the xyz files, or list of folders
+        name_filter : if provided, only files with this string in the name are read (folder only)
+        use_cache : if False, always read the files and do not write any cache
+
+    Returns:
+        features : numpy array of shape (n_frames, 3) with all the trajectories one after the other
+        offsets : trajectory i is features[offsets[i]:offsets[i+1]]
+    """
+    if isinstance(folders, str):
+        folders = [folders]
+    parts = [_load_folder_features(folder, name_filter, use_cache) for folder in folders]
+    if len(parts) == 1:
+        return parts[0]
+    features = np.concatenate([part[0] for part in parts]) if parts else np.zeros((0, 3))
+    lengths = np.concatenate([np.diff(part[1]) for part in parts]) if parts else []
+    return features, np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+
+
+def split_features(array, offsets):
+    """
+    Splits an array with one row per frame (features, discrete trajectory) into the
+    trajectories, as views without copies
+
+    Parameters:
+        array : numpy array with one row per frame
+        offsets : offsets of the trajectories (see load_features)
+
+    Returns:
+        list of numpy arrays, one per trajectory
+    """
+    return [array[start:end] for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
@@ -0,0 +1,85 @@
+import os
+import shutil
+import numpy as np
+import mdtraj as md
+
+# Formats of the visualization outputs: one text pdb per trajectory, or a single
+# binary trajectory (plus a pdb with the topology) written through mdtraj
+VMD_FORMATS = ["pdb", "dcd", "xtc"]
+
+
+def remove_vmd_output(prefix):
+    """
+    Removes the previous visualization outputs, in any format
+
+    Parameters:
+        prefix : folder of the pdb files, also prefix of the binary trajectory files
+    """
+    if os.path.exists(prefix):
+        shutil.rmtree(prefix)
+    for extension in (".pdb", ".dcd", ".xtc", "_frames.txt"):
+        if os.path.exists(prefix + extension):
+            os.remove(prefix + extension)
+
+
+def point_topology(n_atoms):
+    """
+    Topology of points (ligand centers, cluster centers) as written in the text pdb
+    files: one CL atom in a BEN residue per point
+
+    Parameters:
+        n_atoms : number of points
+
+    Returns:
+        mdtraj.Topology
+    """
+    topology = md.Topology()
+    chain = topology.add_chain()
+    for i in range(n_atoms):
+        residue = topology.add_residue("BEN", chain, resSeq=i + 1)
+        topology.add_atom("CL", md.element.chlorine, residue)
+    return topology
+
+
+def write_points_pdb(path, xyz):
+    """
+    Writes a set of points (e.g. the ligand centers of a trajectory, or the cluster
+    centers) as the atoms of a single pdb file, atom i+1 is point i. Same lines as the
+    pdb files of the vmd folders (one CL atom in a BEN residue per point)
+
+    Parameters:
+        path : pdb file name
+        xyz : positions in Angstrom, shape (n_points, 3)
+    """
+    xyz = np.asarray(xyz, dtype=np.float64).reshape(-1, 3)
+    with open(path, "w") as pdb_file:
+        for i, (x, y, z) in enumerate(xyz.tolist(), start=1):
+            pdb_file.write(f"ATOM  {i:5d} CL   BEN A{i:4d}    "
+                           f"{x:8.3f}{y:8.3f}{z:8.3f}  1.00  0.00          CL  \n")
+
+
+def write_vmd_trajectory(prefix, segments, vmd_format="dcd"):
+    """
+    Writes the ligand centers of all the encounter trajectories as a single binary
+    trajectory of one atom, which vmd loads at once:
+    prefix.pdb (topology), prefix.dcd (or .xtc) with all the frames one trajectory after the
+    other, and prefix_frames.txt with the first frame and the number of frames of every trajectory
+
+    Parameters:
+        prefix : name of the output files, without extension
+        segments : list of arrays of shape (n_frames, 3), positions in Angstrom
+        vmd_format : "dcd" or "xtc"
+    """
+    segments = [np.asarray(segment, dtype=np.float64).reshape(-1, 3) for segment in segments]
+    xyz = np.concatenate(segments) if segments else np.zeros((0, 3))
+    # mdtraj works in nm
+    trajectory = md.Trajectory(xyz[:, None, :] / 10, point_topology(1))
+    trajectory[:1].save_pdb(f"{prefix}.pdb")
+    trajectory.save(f"{prefix}.{vmd_format}")
+
+    lengths = [len(segment) for segment in segments]
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1])) if lengths else []
+    with open(f"{prefix}_frames.txt", "w") as fout:
+        fout.write("# trajectory first_frame n_frames\n")
+        for t, (start, length) in enumerate(zip(starts, lengths), start=1):
+            fout.write(f"{t} {start} {length}\n")
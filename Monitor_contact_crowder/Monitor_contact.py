@@ -3,22 +3,15 @@ import mdtraj as md
 import matplotlib.pyplot as plt
 import argparse
 from scipy.spatial.distance import cdist
-from tqdm import tqdm
-
-
-def compute_center_of_geometry(X):
-    """
-    Computes the center of geometry for a given set of atomic positions.
-    
-    Parameters:
-        X (numpy.ndarray): Atomic positions of shape (1, N, 3), where N is the number of atoms.
-    
-    Returns:
-        numpy.ndarray: The center of geometry as a (3,) array.
-    """
-    return X.mean(axis=1).squeeze()  # Compute mean over atoms (axis=1) and remove extra dimensions
-
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tools"))
+from sda_geometry import rotation_matrices, to_sda_frame
+from sda_trajectory import iter_chunks, coordinates, previous_row
 
+# number of close crowder lines whose atomic positions are computed at once: the memory
+# of the positions (lines x atoms x 24 bytes) does not depend on the chunk size
+CLOSE_BLOCK_SIZE = 1024
 
 def read_sda_input(sda_input_file):
     """
@@ -43,55 +36,6 @@ def read_sda_input(sda_input_file):
 
     return xmax-xmin, total_solutes
 
-def vectorial_product(vec1, vec2):
-    """
-    Computes vectorial product between two vectors
-    
-    Parameters:
-        vec1 : list of coordinates of first vector
-        vec2 : list of coordinates of second vector
-    
-    Returns:
-        vec3 : vector defined by the vector product between vec1 and vec2
-    """
-    return vec1[1]*vec2[2]-vec1[2]*vec2[1],vec1[2]*vec2[0]-vec1[0]*vec2[2],vec1[0]*vec2[1]-vec1[1]*vec2[0]
-
-
-def get_position_sda(line_splitted, molecule, com_molecule):
-    """
-    Computes atomic positions in sda reference system
-    
-    Parameters:
-        line_splitted : line in a trajectory file splitted
-        molecule : md trajectory file object of the molecule
-        com_molecule : molecule center of mass
-    
-    Returns:
-        x : position of the molecule in sda ref system
-    """
-    x=molecule.xyz*10 -com_molecule[0]
-    #Save traslations coordinates
-    tx, ty, tz = float(line_splitted[2]), float(line_splitted[3]), float(line_splitted[4])
-    
-    #Save rotation Matrix elements
-    r1x, r1y, r1z = float(line_splitted[5]), float(line_splitted[6]), float(line_splitted[7]) 
-    r2x, r2y, r2z = float(line_splitted[8]), float(line_splitted[8]), float(line_splitted[10]) 
-    r3x, r3y, r3z = vectorial_product([r1x, r1y, r1z],[r2x, r2y, r2z])
-    
-    #Save the rotation Matrix elements in the rotation Matrix
-    RM=np.zeros((3,3))
-    RM[0,:]=r1x,r1y,r1z
-    RM[1,:]=r2x,r2y,r2z
-    RM[2,:]=r3x,r3y,r3z
-    
-    #Transpose cause Fortran saves by column,
-    RM=RM.transpose()
-
-    x=x@RM.T+np.array([tx, ty, tz ])
-
-    return x
-
-
 def main(args):
     """
     Main function
@@ -125,57 +69,74 @@ def main(args):
     previous_bounded=np.zeros(total_solutes)
     times=[]
 
-    #Read trajectory file
-    with open(ftrajectories,"r") as fin:
-        traj_lines=fin.readlines()[2:]
-    
-    for i,line in tqdm(enumerate(traj_lines), total=len(traj_lines)):
-
-        line_splitted=line.split()
-    
-        if int(line_splitted[1])==group_type:
-
-            molecule_pos = get_position_sda(line_splitted, molecule, com_molecule)
-            molecule_com=compute_center_of_geometry(molecule_pos)
-
-            #translate the molecule in the center of the box (easy way to avoid counting PBC)
-            vt=L/2-molecule_com
-            molecule_pos=molecule_pos+vt
-            
-
-        if int(line_splitted[1])>1:   
-            crowder_pos = get_position_sda(line_splitted, crowd, com_crowd)
-
-            #translate atoms position by vt because we centered the molecule in the center of the box
-            crowder_pos = crowder_pos +vt
+    #atomic positions of molecule and crowder in their own reference system
+    molecule_body=molecule.xyz[0]*10-com_molecule[0]
+    crowd_body=crowd.xyz[0]*10-com_crowd[0]
 
-            #print(np.sqrt(((compute_center_of_geometry(molecule_pos)-compute_center_of_geometry(crowder_pos))**2).sum()))
-
-            #check if the two coms are withing a bigger distance (to save computational time)
-            if np.sqrt(((compute_center_of_geometry(molecule_pos)-compute_center_of_geometry(crowder_pos))**2).sum()) < dist_coms:
-                dist_matrix=cdist(molecule_pos[0],crowder_pos[0])
-                min_dist=np.min(dist_matrix)
-                _, atom_crowd=np.unravel_index(np.argmin(cdist(molecule_pos[0],crowder_pos[0])), cdist(molecule_pos[0],crowder_pos[0]).shape)
+    #Read trajectory file
+    chunk_size=None if args.chunk_size is None else int(args.chunk_size*1024**2)
+    for records in iter_chunks(ftrajectories, run_column=False, chunk_size=chunk_size, use_cache=not args.no_cache):
+
+        #rotation matrices and translations of all the lines of the chunk
+        R=rotation_matrices(coordinates(records, "r1"), coordinates(records, "r2"))
+        translations=coordinates(records, "t")
+        solutes=records["solute"].tolist()
+
+        #for each crowder line, the line of the molecule in the same frame
+        molecule_rows=previous_row(records, group_type)
+        crowd_rows=np.flatnonzero((records["solute"]>1) & (molecule_rows>=0))
+        crowd_molecule_rows=molecule_rows[crowd_rows]
+
+        #check if the two centers of geometry are withing a bigger distance (to save computational time).
+        #The molecule is in the center of the box (easy way to avoid counting PBC) and the crowder is
+        #translated by the same vector, so it is the plain distance between the two centers
+        molecule_cog=to_sda_frame(molecule_body.mean(axis=0, keepdims=True), R[crowd_molecule_rows], translations[crowd_molecule_rows])[:,0]
+        crowd_cog=to_sda_frame(crowd_body.mean(axis=0, keepdims=True), R[crowd_rows], translations[crowd_rows])[:,0]
+        close=np.sqrt(((molecule_cog-crowd_cog)**2).sum(axis=1)) < dist_coms
+
+        #atomic positions only for the close crowders, and for each molecule line once,
+        #in blocks of close crowder lines
+        min_dists=np.zeros(len(crowd_rows))
+        atoms_crowd=np.zeros(len(crowd_rows), dtype=int)
+        close_idx=np.flatnonzero(close)
+        for start in range(0, len(close_idx), CLOSE_BLOCK_SIZE):
+            block=close_idx[start:start+CLOSE_BLOCK_SIZE]
+            block_rows=crowd_rows[block]
+            crowder_pos=to_sda_frame(crowd_body, R[block_rows], translations[block_rows])
+            unique_rows, molecule_idx=np.unique(crowd_molecule_rows[block], return_inverse=True)
+            molecule_pos=to_sda_frame(molecule_body, R[unique_rows], translations[unique_rows])
+
+            for k,c in enumerate(block):
+                dist_matrix=cdist(molecule_pos[molecule_idx[k]],crowder_pos[k])
+                _, atoms_crowd[c]=np.unravel_index(np.argmin(dist_matrix), dist_matrix.shape)
+                min_dists[c]=dist_matrix.min()
+
+        for c,row in enumerate(crowd_rows):
+
+            solute_idx=solutes[row]
+            min_dist=min_dists[c]
+
+            if close[c]:
                 if min_dist<=minimum_dist:
-                    atom_selected=crowd_top.atom(atom_crowd)
+                    atom_selected=crowd_top.atom(int(atoms_crowd[c]))
                     residue_selected=atom_selected.residue.index
                     crowd_residue_contacts[residue_selected]+=1 #remember this is translated by 1:python starts enumerating at 1, pdb at 0
-                    crowd_number[int(line_splitted[1])-1]+=1
+                    crowd_number[solute_idx-1]+=1
 
                     #check if previous time was bounded
                     #if previous_bounded[int(line.split()[2])-1]==1:
-                    time_bounded[int(line_splitted[1])-1]+=1
-                    previous_bounded[int(line_splitted[1])-1]=1
+                    time_bounded[solute_idx-1]+=1
+                    previous_bounded[solute_idx-1]=1
             
-                if min_dist>minimum_dist and previous_bounded[int(line_splitted[1])-1]==1:
-                    times.append(time_bounded[int(line_splitted[1])-1])
-                    previous_bounded[int(line_splitted[1])-1]=0
-                    time_bounded[int(line_splitted[1])-1]=0
+                if min_dist>minimum_dist and previous_bounded[solute_idx-1]==1:
+                    times.append(time_bounded[solute_idx-1])
+                    previous_bounded[solute_idx-1]=0
+                    time_bounded[solute_idx-1]=0
 
-            if np.sqrt(((compute_center_of_geometry(molecule_pos)-compute_center_of_geometry(crowder_pos))**2).sum()) >= dist_coms and previous_bounded[int(line_splitted[1])-1]==1:
-                times.append(time_bounded[int(line_splitted[1])-1])
-                previous_bounded[int(line_splitted[1])-1]=0
-                time_bounded[int(line_splitted[1])-1]=0
+            if not close[c] and previous_bounded[solute_idx-1]==1:
+                times.append(time_bounded[solute_idx-1])
+                previous_bounded[solute_idx-1]=0
+                time_bounded[solute_idx-1]=0
 
     np.save(args.output_folder+"/"+"crowd_residue_contacts_"+args.trajectory, crowd_residue_contacts)
     np.save(args.output_folder+"/"+"bounded_times_"+args.trajectory, np.array(times))
@@ -196,6 +157,8 @@ if __name__ == "__main__":
     parser.add_argument("--dist_coms", help = "necessary distance to check if there is a contact (to speed up)", type=float, required = True)
     parser.add_argument("--contact_dist", help = "distance to define a contact", type=float, required = True)
     parser.add_argument("--output_folder", help = "name of the output folder where to save data", type=str, required = True)
+    parser.add_argument("--chunk_size", help = "if provided, read the trajectory in chunks of this size (MB) to bound the memory", type=float, required = False, default=None)
+    parser.add_argument("--no_cache", help = "always parse the trajectory file, do not read or write the binary cache", action="store_true")
 
 
     args = parser.parse_args()
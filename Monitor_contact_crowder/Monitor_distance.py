@@ -3,6 +3,11 @@ import MDAnalysis as mda
 import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import tqdm
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tools"))
+from sda_geometry import rotation_matrices, to_sda_frame, pbc_distance
+from sda_trajectory import iter_chunks, previous_row
 
 def read_sda_input(sda_input_file):
     """
@@ -27,22 +32,6 @@ def read_sda_input(sda_input_file):
 
     return xmax-xmin, total_solutes
 
-def distance_pbc(x0, x1, dimensions):
-    """
-    Computes PBC distances from relative distances
-    
-    Parameters:
-        x0 and x1: two arrays. In this case x0.shape = (N_atoms, 3); x0.shape = (3)
-        dimensions: box size
-    
-    Returns:
-        numpy.ndarray: distances in PBC
-    """
-    delta = np.abs(x0 - x1)
-    delta = np.where(delta > 0.5 * dimensions, delta - dimensions, delta)
-    
-    return np.sqrt((delta ** 2).sum(axis=-1))
-
 def compute_center_of_geometry(X):
     """
     Computes the center of geometry for a given set of atomic positions.
@@ -56,33 +45,6 @@ def compute_center_of_geometry(X):
 
     return X.mean(axis=0).squeeze()  # Compute mean over atoms (axis=0) and remove extra dimensions
 
-def read_frame(line):
-    """
-    Function to read SDA frame
-    
-    Parameters:
-        line : SDA trajectory line
-        
-    Returns : frame, solute_idx, tx, ty, tz, r1x, r1y, r1z, r2x, r2y, r2z
-        
-    """
-    parts=line.split()
-    return int(parts[1]), int(parts[2]), float(parts[3]), float(parts[4]), float(parts[5]), float(parts[6]), float(parts[7]), float(parts[8]), float(parts[9]), float(parts[10]), float(parts[11])
-
-def vectorial_product(vec1, vec2):
-    """
-    Computes vectorial product between two vectors
-    
-    Parameters:
-        vec1 : list of coordinates of first vector
-        vec2 : list of coordinates of second vector
-    
-    Returns:
-        vec3 : vector defined by the vector product between vec1 and vec2
-    """
-    return vec1[1]*vec2[2]-vec1[2]*vec2[1],vec1[2]*vec2[0]-vec1[0]*vec2[2],vec1[0]*vec2[1]-vec1[1]*vec2[0]
-
-
 def main(args):
     """
     Main function
@@ -118,41 +80,30 @@ def main(args):
     reaction_atoms_coordinates=np.array(reaction_atoms_coordinates)
         
     #Load trajectories
-    with open(args.trajectory,"r") as fin:
-        traj_lines=fin.readlines()[2:]
+    chunk_size=None if args.chunk_size is None else int(args.chunk_size*1024**2)
         
         
     min_distaces=[]
         
-    #iterate over frames
-    for line in tqdm(traj_lines):
-        frame, solute_idx, tx, ty, tz, r1x, r1y, r1z, r2x, r2y, r2z = read_frame(line)
-        r3x, r3y, r3z = vectorial_product([r1x, r1y, r1z],[r2x, r2y, r2z])
-        
-        #If the molecule is the protein
-        if solute_idx == 1:
-            #define rotation matrix
-            RM = np.array([[r1x,r1y,r1z],[r2x, r2y, r2z], [r3x, r3y, r3z]])
-            #Transpose cause Fortran saves by column,
-            RM=RM.transpose()
-            
-            # x are coordinates of the entire protein, xrxna coordinates of reaction atoms
-            x=np.dot(protein.atoms.positions-protein_com, RM.T)+np.array([tx, ty, tz])
-            xrxna=np.dot(reaction_atoms_coordinates-protein_com, RM.T)+np.array([tx, ty, tz])
-            
-            distances_from_crowders=[]
-            
-        #else is a crowder
-        else:
-            #get crowder distances to reaction atoms coordinates
-            distances=xrxna-np.array([tx, ty, tz])
-            distances_pbc=distance_pbc(xrxna, np.array([tx, ty, tz]),L)
-            distances_from_crowders.append(distances_pbc)
-        
+    #iterate over chunks of frames
+    for records in tqdm(iter_chunks(args.trajectory, chunk_size=chunk_size, use_cache=False)):
+        #line of the protein in the frame of every line
+        protein_rows=previous_row(records, 1)
+        protein_lines=np.flatnonzero(records["solute"]==1)
+
+        # xrxna coordinates of reaction atoms, for every protein line
+        R=rotation_matrices(records["r1"][protein_lines], records["r2"][protein_lines])
+        xrxna=to_sda_frame(reaction_atoms_coordinates-protein_com, R, records["t"][protein_lines])
+
+        #get crowder distances to reaction atoms coordinates, minimum over the reaction atoms
+        crowd_rows=np.flatnonzero((records["solute"]!=1) & (protein_rows>=0))
+        row_min=np.full(len(records), np.inf)
+        row_min[crowd_rows]=pbc_distance(xrxna[np.searchsorted(protein_lines, protein_rows[crowd_rows])], records["t"][crowd_rows,None], L).min(axis=1)
+
         # If we are at the last crowder, save the minimum distances between reactive atoms
         # and crowders
-        if solute_idx == total_solutes:
-            min_distaces.append(np.min(distances_from_crowders))
+        for row in np.flatnonzero((records["solute"]==total_solutes) & (protein_rows>=0)):
+            min_distaces.append(row_min[protein_rows[row]+1:row+1].min())
 
     plt.hist(min_distaces, bins=50)
     plt.show()
@@ -167,6 +118,7 @@ if __name__ == "__main__":
     parser.add_argument("--reaction_file", help = "reaction coordinate file", type=str, required = True)
     parser.add_argument("--protein", help = "pqr file of protein", type=str, required = True)
     parser.add_argument("--sda_input_file", help = "sda input file name", type=str, required = True)
+    parser.add_argument("--chunk_size", help = "if provided, read the trajectory in chunks of this size (MB) to bound the memory", type=float, required = False, default=None)
 
     args = parser.parse_args()
     
@@ -4,6 +4,7 @@ from tqdm import tqdm
 import argparse
 
 import numpy as np
+from sda_trajectory import iter_chunks, is_cache_file, coordinates, strip_compression
 
 def unwrap_positions(positions, box_xmin=0, box_xmax=240, box_ymin=0, box_ymax=240, box_zmin=0, box_zmax=240):
     """
@@ -76,7 +77,7 @@ def read_sda_input_file(folder, file):
     Returns:
         timestep, frequency of printing and box size of the simulation
     """
-    num_traj=file.replace('trajectories','')
+    num_traj=strip_compression(file).replace('trajectories','')
     with open(f"./{folder}/sdamm_crowd"+num_traj+".in") as sda_input:
         sda_input_lines=sda_input.readlines()
     for sda_line in sda_input_lines:
@@ -91,33 +92,21 @@ def read_sda_input_file(folder, file):
     return dt, frequency, box_size
     
     
-def load_positions(lines, solute_idx, start_time):
+def load_positions(records, solute_idx, start_time):
     """
     load position from trajectories. Only solute_idx positions are loaded
     
     Parameters:
-        - lines of trjactory file
+        - records of trjactory file (see sda_trajectory.read_trajectory)
         - solute idx of interested solute
         - start time value for considering equilibration
     
     Returns:
         numpy array with positions
     """
-    positions=[]
-    
-    # iterate over line of the trajectory file
-    for line in lines[2:]:
-        parts = line.split()  # Split the line only once
-        current_solute_idx = int(parts[1])
-
-        # if the solute index of that file is 1 i.e. the molecule of interest, save pos
-        if current_solute_idx == solute_idx:
-            pos_t = np.array([float(parts[2]), float(parts[3]), float(parts[4])])
-
-            # save only positions above the start time
-            if int(parts[0])>=start_time:
-                positions.append(pos_t)
-    positions=np.array(positions)
+    # select the molecule of interest and save only positions above the start time
+    mask = (records["solute"] == solute_idx) & (records["frame"] >= start_time)
+    positions = coordinates(records[mask], "t")
     
     return positions
 
@@ -134,7 +123,7 @@ def write_diffusion_coefficients(Ds, densities, name_output_file):
         for d,density in enumerate(densities):
             fout.write(str(density) + " " + str(Ds[d]) + "\n")
 
-def main(rejected_frames, solute_idx, min_time_fit, max_time_fit, name_output_file, folder_figures):
+def main(rejected_frames, solute_idx, min_time_fit, max_time_fit, name_output_file, folder_figures, use_cache=True, chunk_size=None):
     densities=[]
     Ds=[]
 
@@ -150,15 +139,12 @@ def main(rejected_frames, solute_idx, min_time_fit, max_time_fit, name_output_fi
             
             # iterate over files in folder
             for file in tqdm(os.listdir(f"./{folder}")):
-                #select only trajectory files
-                if "trajectories" in file:
+                #select only trajectory files (not their binary cache)
+                if "trajectories" in file and not is_cache_file(file):
                     
                     # define position and unwrapped_position lists
                     positions = []
                     positions_unwrapped = []
-                    with open(f"./{folder}/{file}", "r") as fin:
-                        lines = fin.readlines()
-                        
                     #Read parameters from sda_input file
                     dt, frequency, box_size = read_sda_input_file(folder,file)
                                        
@@ -166,12 +152,19 @@ def main(rejected_frames, solute_idx, min_time_fit, max_time_fit, name_output_fi
                     start_time=rejected_frames*frequency
                     time_step=dt*frequency
                     
+                    # Load positions of requires solute
+                    # (the trajectory is read chunk by chunk if chunk_size is provided)
+                    chunks=[load_positions(records, solute_idx, start_time)
+                            for records in iter_chunks(f"./{folder}/{file}", run_column=False, chunk_size=chunk_size, use_cache=use_cache)]
+                    # an empty (or header only) trajectory gives no chunk and no msd
+                    if len(chunks)==0 or sum(len(chunk) for chunk in chunks)==0:
+                        print(f"No frames of solute {solute_idx} in ./{folder}/{file}, skipped")
+                        continue
+                    positions=np.concatenate(chunks)
+
                     #increment number of trajectories for that density
                     count_trajs+=1
 
-                    # Load positions of requires solute
-                    positions=load_positions(lines, solute_idx, start_time)
-
                     # Unwrap the trajectory
                     unwrapped_positions = unwrap_positions(positions, box_xmin=0, box_xmax=box_size, box_ymin=0, box_ymax=box_size, box_zmin=0, box_zmax=box_size)
 
@@ -190,6 +183,10 @@ def main(rejected_frames, solute_idx, min_time_fit, max_time_fit, name_output_fi
                         msd[t-1]+=np.sum(displacement**2)
 
             
+            if count_trajs==0:
+                print(f"No trajectory with frames in {folder}, skipped")
+                continue
+
             # average msd values over all trajectories
             times=[]
             for t in range(1,T):
@@ -228,9 +225,12 @@ if __name__ == "__main__":
     parser.add_argument("--max_time_fit", type=int, required=False, default=-1, help="maximum time where to end msd vs t fit")
     parser.add_argument("--name_output_file", type=str, required=False, default="diff_coeff.txt", help="name of output file to save diffusion coefficients")
     parser.add_argument("--folder_figures", type=str, required=False, default="images_diff", help="folder where to save diffusion images")
+    parser.add_argument("--chunk_size", type=float, required=False, default=None, help="if provided, read trajectories in chunks of this size (MB) to bound the memory")
+    parser.add_argument("--no_cache", action="store_true", help="always parse trajectory files, do not read or write the binary cache")
 
     # Parse arguments
     args = parser.parse_args()
 
     # Perform calculation
-    main(args.rejected_frames, args.solute_idx, args.min_time_fit, args.max_time_fit, args.name_output_file, args.folder_figures)
+    main(args.rejected_frames, args.solute_idx, args.min_time_fit, args.max_time_fit, args.name_output_file, args.folder_figures, not args.no_cache,
+         None if args.chunk_size is None else int(args.chunk_size*1024**2))
@@ -0,0 +1,153 @@
+import os
+import sys
+import time
+import runpy
+import argparse
+import warnings
+import traceback
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+
+
+def parse_indexes(values):
+    """
+    Parses the indexes of the files to analyze
+
+    Parameters:
+        values : list of strings, each one an integer (e.g. 84) or an inclusive range (e.g. 1-1000)
+
+    Returns:
+        sorted list of unique integers
+    """
+    indexes=set()
+    for value in values:
+        if "-" in value:
+            first, last=value.split("-")
+            indexes.update(range(int(first), int(last)+1))
+        else:
+            indexes.add(int(value))
+    return sorted(indexes)
+
+
+def fill_arguments(arguments, index):
+    """
+    Replaces the {i} placeholder with the file index in the arguments of the analysis script
+
+    Parameters:
+        arguments : list of strings (e.g. ["sdamm_crowd_{i}.in", "../data_grid/p1_noh.pdb"])
+        index : index of the file
+
+    Returns:
+        list of strings
+    """
+    return [argument.replace("{i}", str(index)) for argument in arguments]
+
+
+def run_script(script, arguments, log_file):
+    """
+    Runs an analysis script inside the current (worker) process, as if it was called
+    from the command line, with its output redirected to a log file.
+    Running it in a long-lived worker instead of a new python process saves the
+    start-up and import time (mdtraj, numpy, ...) for every file. As with python script.py,
+    the folder of the script is first in sys.path (for its sibling modules, e.g. sda_encounter);
+    sys.path, the warning filters and the matplotlib figures are reset after every file.
+
+    Parameters:
+        script : path of the python script
+        arguments : list of command line arguments of the script
+        log_file : file where stdout and stderr of the script are written
+
+    Returns:
+        status : "ok" or "failed"
+        seconds : running time
+        message : last line of the error, empty if the script succeeded
+    """
+    start=time.time()
+    status, message="ok", ""
+    argv=sys.argv
+    path=list(sys.path)
+    sys.argv=[script]+arguments
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    with open(log_file, "w") as flog, contextlib.redirect_stdout(flog), contextlib.redirect_stderr(flog), warnings.catch_warnings():
+        try:
+            runpy.run_path(script, run_name="__main__")
+        except SystemExit as error:
+            if error.code not in (None, 0):
+                status, message="failed", f"exit status {error.code}"
+        except BaseException as error:
+            traceback.print_exc()
+            status, message="failed", f"{type(error).__name__}: {error}"
+        finally:
+            sys.argv=argv
+            sys.path[:]=path
+            #figures left open by the script would pile up in the worker
+            if "matplotlib.pyplot" in sys.modules:
+                sys.modules["matplotlib.pyplot"].close("all")
+    return status, time.time()-start, message
+
+
+def main(args):
+    """
+    Main function
+    """
+    indexes=parse_indexes(args.indexes.replace(",", " ").split())
+    if args.indexes_file is not None:
+        with open(args.indexes_file, "r") as fin:
+            indexes=sorted(set(indexes) | set(parse_indexes(fin.read().split())))
+    if len(indexes)==0:
+        sys.exit("No file index provided, use --indexes or --indexes_file")
+
+    script=os.path.abspath(args.script)
+    script_name=os.path.splitext(os.path.basename(script))[0]
+    os.makedirs(args.log_folder, exist_ok=True)
+
+    #every worker uses a single core, the parallelism is over the files
+    os.environ["OMP_NUM_THREADS"]="1"
+    os.environ["OPENBLAS_NUM_THREADS"]="1"
+    os.environ["MKL_NUM_THREADS"]="1"
+
+    results={}
+    with ProcessPoolExecutor(max_workers=args.n_jobs) as executor:
+        futures={executor.submit(run_script, script, fill_arguments(args.script_arguments, i),
+                                 os.path.join(args.log_folder, f"{script_name}_{i}.log")): i for i in indexes}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            i=futures[future]
+            try:
+                results[i]=future.result()
+            except BaseException as error:
+                #the worker itself died (e.g. killed because out of memory)
+                results[i]=("failed", 0.0, f"{type(error).__name__}: {error}")
+
+    #summary in the order of the indexes, whatever the order the files have been completed
+    failed=[i for i in indexes if results[i][0]!="ok"]
+    with open(os.path.join(args.log_folder, f"summary_{script_name}.txt"), "w") as fout:
+        fout.write("# index status seconds message\n")
+        for i in indexes:
+            status, seconds, message=results[i]
+            fout.write(f"{i} {status} {seconds:.1f} {message}\n")
+
+    print(f"{len(indexes)-len(failed)}/{len(indexes)} files analyzed with {script_name}")
+    for i in failed:
+        print(f"  {i} failed: {results[i][2]} (see {os.path.join(args.log_folder, f'{script_name}_{i}.log')})")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Python script to run an analysis script over many sda files (e.g. the outputs of a SLURM array) "
+                                     "in parallel. {i} in the arguments of the script is replaced by the file index. "
+                                     "A file failing does not stop the others: the status of every file is written in log_folder/summary_<script>.txt",
+                                     epilog="Example usage:\n"
+                                    "python run_batch.py --indexes 1-1000 --n_jobs 32 ../MarkovStateModel/Get_encounter_traj.py sdamm_crowd_{i}.in ../data_grid/p1_noh.pdb ../data_grid/p2_noh.pdb 30")
+    parser.add_argument("--indexes", help = "indexes of the files, as integers or inclusive ranges (e.g. 1-1000 or \"84 159 190\")", type=str, required = False, default="")
+    parser.add_argument("--indexes_file", help = "file with the indexes of the files (e.g. the output of find_encounter_files.py)", type=str, required = False, default=None)
+    parser.add_argument("--n_jobs", help = "number of parallel processes, by default all the cores", type=int, required = False, default=os.cpu_count())
+    parser.add_argument("--log_folder", help = "folder where to save the log of every file and the summary", type=str, required = False, default="batch_logs")
+    parser.add_argument("script", help = "python analysis script to run", type=str)
+    parser.add_argument("script_arguments", help = "arguments of the analysis script, {i} is replaced by the file index", nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+
+    main(args)
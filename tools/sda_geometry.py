@@ -0,0 +1,94 @@
+import numpy as np
+
+
+def rotation_matrices(r1, r2):
+    """
+    Builds the rotation matrices of many sda frames at once.
+
+    sda prints the first two rows r1 and r2 of the rotation matrix, the third
+    one is r1 x r2. As in the original scripts the matrix is transposed (Fortran
+    saves by column), so the columns of each matrix are r1, r2 and r1 x r2.
+
+    Parameters:
+        r1 : numpy array of shape (N, 3) (or (3,) for a single frame)
+        r2 : numpy array of shape (N, 3) (or (3,) for a single frame)
+
+    Returns:
+        numpy array of shape (N, 3, 3) (or (3, 3)) with the rotation matrices
+    """
+    r1 = np.asarray(r1, dtype=np.float64)
+    r2 = np.asarray(r2, dtype=np.float64)
+    return np.stack((r1, r2, np.cross(r1, r2)), axis=-1)
+
+
+def to_sda_frame(body_xyz, rotations, translations):
+    """
+    Places a rigid molecule in the sda reference system for many frames at once
+
+    Parameters:
+        body_xyz : atomic positions relative to the molecule center, shape (n_atoms, 3)
+        rotations : rotation matrices, shape (N, 3, 3)
+        translations : translation vectors, shape (N, 3)
+
+    Returns:
+        numpy array of shape (N, n_atoms, 3) with the atomic positions of every frame
+    """
+    return np.einsum("nij,aj->nai", rotations, body_xyz) + np.asarray(translations)[:, None, :]
+
+
+def rotate(rotations, vectors):
+    """
+    Applies a stack of rotations to a stack of vectors (R @ v for every frame)
+
+    Parameters:
+        rotations : numpy array of shape (N, 3, 3)
+        vectors : numpy array of shape (N, 3) or (N, n_atoms, 3)
+
+    Returns:
+        numpy array with the same shape as vectors
+    """
+    return np.einsum("nij,n...j->n...i", rotations, vectors)
+
+
+def rotate_back(rotations, vectors):
+    """
+    Applies the inverse (transposed) rotations to a stack of vectors (R.T @ v for every frame),
+    i.e. brings vectors from the sda reference system to the body frame of the molecule
+
+    Parameters:
+        rotations : numpy array of shape (N, 3, 3)
+        vectors : numpy array of shape (N, 3) or (N, n_atoms, 3)
+
+    Returns:
+        numpy array with the same shape as vectors
+    """
+    return np.einsum("nji,n...j->n...i", rotations, vectors)
+
+
+def pbc_delta(x1, x0, box_size):
+    """
+    Minimum image difference vector x1 - x0 in a cubic periodic box
+
+    Parameters:
+        x1, x0 : numpy arrays of positions, broadcastable to each other (..., 3)
+        box_size : box length
+
+    Returns:
+        numpy array with the minimum image differences
+    """
+    delta = np.asarray(x1) - np.asarray(x0)
+    return delta - box_size * np.round(delta / box_size)
+
+
+def pbc_distance(x1, x0, box_size):
+    """
+    Minimum image distance between positions in a cubic periodic box
+
+    Parameters:
+        x1, x0 : numpy arrays of positions, broadcastable to each other (..., 3)
+        box_size : box length
+
+    Returns:
+        numpy array with the distances (last axis reduced)
+    """
+    return np.sqrt(np.sum(pbc_delta(x1, x0, box_size)**2, axis=-1))
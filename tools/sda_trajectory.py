@@ -0,0 +1,845 @@
+import bz2
+import gzip
+import json
+import lzma
+import os
+import numpy as np
+
+# Number of header lines at the top of an sda trajectory/complexes file
+HEADER_LINES = 2
+
+# One record per line of an sda trajectory file.
+# run    : number of the simulation run (0 if the file has no run column)
+# frame  : simulation step printed in the trajectory
+# solute : solute index (1 = p1, 2 = p2, >2 crowders)
+# t      : translation vector of the solute
+# r1, r2 : first two rows of the rotation matrix (third one is r1 x r2)
+# offset : byte offset of the line in the source file
+TRAJ_DTYPE = np.dtype([
+    ("run", np.int64),
+    ("frame", np.int64),
+    ("solute", np.int32),
+    ("t", np.float64, (3,)),
+    ("r1", np.float64, (3,)),
+    ("r2", np.float64, (3,)),
+    ("offset", np.int64),
+])
+
+# Same records stored in single precision in the binary cache: sda prints
+# 3 decimals and float32 keeps them only below FLOAT32_MAX_VALUE (24 bits of
+# mantissa, 10 of them for the 3 decimals)
+CACHE_DTYPE = np.dtype([
+    ("run", np.int64),
+    ("frame", np.int64),
+    ("solute", np.int32),
+    ("t", np.float32, (3,)),
+    ("r1", np.float32, (3,)),
+    ("r2", np.float32, (3,)),
+    ("offset", np.int64),
+])
+FLOAT32_MAX_VALUE = 2**14
+
+# Suffix of the binary cache written next to a trajectory file
+CACHE_SUFFIX = ".sdacache"
+
+# One entry per frame block (all the solutes of a run at a given frame)
+# start, end : byte range of the block in the (decompressed) trajectory file,
+#              end = -1 for the last block, which goes to the end of the file
+# row, n_rows : first record of the block and number of records
+INDEX_DTYPE = np.dtype([
+    ("run", np.int64),
+    ("frame", np.int64),
+    ("start", np.int64),
+    ("end", np.int64),
+    ("row", np.int64),
+    ("n_rows", np.int64),
+])
+
+# Suffix of the frame index written next to a trajectory file
+INDEX_SUFFIX = ".sdaindex"
+
+# Chunk size (bytes) used when a whole trajectory has to be scanned
+DEFAULT_CHUNK_SIZE = 64 * 1024**2
+
+# Compressed files are read and written through a streaming decoder
+COMPRESSED_EXTENSIONS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+COMPRESSED_MAGIC = {b"\x1f\x8b": gzip.open, b"BZh": bz2.open, b"\xfd7zXZ\x00": lzma.open}
+
+
+def open_file(path, mode="r"):
+    """
+    Opens a plain or compressed (gzip, bz2, xz) file.
+
+    The compression is taken from the extension of the file name or, when
+    reading, from the first bytes of the file.
+
+    Parameters:
+        path : file name
+        mode : same as the built-in open ("r", "rb", "w", "w+", ...)
+
+    Returns:
+        file object, decompressed on the fly
+    """
+    opener = _decoder(path, read="r" in mode)
+    if opener is None:
+        return open(path, mode)
+
+    # compressed streams can not be updated in place
+    mode = mode.replace("+", "")
+    if "b" not in mode and "t" not in mode:
+        mode += "t"
+    return opener(path, mode)
+
+
+def _decoder(path, read=True):
+    """
+    Function opening a compressed file (gzip.open, bz2.open or lzma.open), None for
+    a plain file. When reading, the compression is also detected from the first bytes
+    """
+    opener = COMPRESSED_EXTENSIONS.get(os.path.splitext(path)[1])
+    if opener is None and read:
+        with open(path, "rb") as fin:
+            magic = fin.read(6)
+        for start, magic_opener in COMPRESSED_MAGIC.items():
+            if magic.startswith(start):
+                opener = magic_opener
+    return opener
+
+
+def resolve_path(path):
+    """
+    Name of the file to read: path itself or, if it does not exist, its
+    compressed version (path.gz, path.bz2 or path.xz)
+    """
+    if os.path.exists(path):
+        return path
+    for extension in COMPRESSED_EXTENSIONS:
+        if os.path.exists(path + extension):
+            return path + extension
+    return path
+
+
+def compressed_name(path, compress=None):
+    """
+    Name of an output file, with the extension of the compression if any
+
+    Parameters:
+        path : file name
+        compress : None, "gz", "bz2" or "xz"
+    """
+    return path if compress is None else path + "." + compress
+
+
+def strip_compression(path):
+    """
+    File name without the extension of the compression
+    """
+    root, extension = os.path.splitext(path)
+    return root if extension in COMPRESSED_EXTENSIONS else path
+
+
+def _column_layout(run_column):
+    """
+    Column index of each field in a splitted trajectory line
+
+    Parameters:
+        run_column : True if the first column is the run number (sda association
+                     trajectories), False if lines start with the frame (sdamm)
+
+    Returns:
+        dictionary field -> first column index
+    """
+    first = 1 if run_column else 0
+    return {"run": 0 if run_column else None,
+            "frame": first,
+            "solute": first + 1,
+            "t": first + 2,
+            "r1": first + 5,
+            "r2": first + 8}
+
+
+def coordinates(records, field):
+    """
+    Coordinates of a records array in double precision
+
+    Records memory mapped from the binary cache are stored in float32: they are
+    rounded back to the 3 decimals printed by sda so that cached and parsed
+    trajectories give the same numbers.
+
+    Parameters:
+        records : records array (see TRAJ_DTYPE and CACHE_DTYPE)
+        field : "t", "r1" or "r2"
+
+    Returns:
+        numpy array of shape (N, 3) with float64 values
+    """
+    values = records[field]
+    if values.dtype == np.float32:
+        return np.round(values.astype(np.float64), 3)
+    return np.asarray(values)
+
+
+def read_header(path, n_lines=HEADER_LINES):
+    """
+    Reads the header lines of an sda trajectory file
+
+    Parameters:
+        path : trajectory file name
+        n_lines : number of header lines
+
+    Returns:
+        list with the header lines (new line character included)
+    """
+    header = []
+    with open_file(path, "r") as fin:
+        for _ in range(n_lines):
+            header.append(fin.readline())
+    return header
+
+
+def _line_starts(text):
+    """
+    Byte offsets of the non empty lines of a text block
+
+    Parameters:
+        text : bytes
+
+    Returns:
+        numpy array with the offset of the first character of each line
+    """
+    buffer = np.frombuffer(text, dtype=np.uint8)
+    starts = np.concatenate(([0], np.flatnonzero(buffer == ord("\n")) + 1))
+    starts = starts[starts < len(buffer)]
+    # skip empty lines
+    return starts[~np.isin(buffer[starts], (ord("\n"), ord("\r")))]
+
+
+def parse_lines(text, run_column=True, offset=0):
+    """
+    Parses a block of trajectory lines (no header) into a records array in bulk.
+
+    All the numbers are converted by a single numpy call instead of splitting
+    every line in python.
+
+    Parameters:
+        text : str or bytes with the trajectory lines
+        run_column : True if the first column is the run number
+        offset : byte offset of text in the source file, used for the offset field
+
+    Returns:
+        numpy structured array with dtype TRAJ_DTYPE, one record per line
+    """
+    if isinstance(text, str):
+        text = text.encode()
+    if not text.strip():
+        return np.zeros(0, dtype=TRAJ_DTYPE)
+
+    starts = _line_starts(text)
+    first_line = text[starts[0]:].split(b"\n", 1)[0]
+    n_columns = len(first_line.split())
+    values = np.fromstring(text, dtype=np.float64, sep=" ")
+    if values.size != n_columns * len(starts):
+        raise ValueError(f"Trajectory lines do not all have {n_columns} columns")
+    values = values.reshape(-1, n_columns)
+
+    layout = _column_layout(run_column)
+    if n_columns < layout["t"] + 3:
+        raise ValueError(f"Trajectory lines have only {n_columns} columns")
+
+    records = np.zeros(len(values), dtype=TRAJ_DTYPE)
+    if run_column:
+        records["run"] = values[:, layout["run"]]
+    records["frame"] = values[:, layout["frame"]]
+    records["solute"] = values[:, layout["solute"]]
+    for field in ("t", "r1", "r2"):
+        col = layout[field]
+        if n_columns >= col + 3:
+            records[field] = values[:, col:col + 3]
+        else:
+            # position only trajectories, no orientation printed
+            records[field] = np.nan
+    records["offset"] = starts + offset
+    return records
+
+
+def read_trajectory(path, run_column=True, n_header=HEADER_LINES):
+    """
+    Reads an sda trajectory file into a records array
+
+    Parameters:
+        path : trajectory file name
+        run_column : True if the first column is the run number
+        n_header : number of header lines to skip
+
+    Returns:
+        numpy structured array with dtype TRAJ_DTYPE, one record per line
+    """
+    with open_file(path, "rb") as fin:
+        for _ in range(n_header):
+            fin.readline()
+        offset = fin.tell()
+        text = fin.read()
+    return parse_lines(text, run_column=run_column, offset=offset)
+
+
+def read_lines(path, offsets):
+    """
+    Reads the original text lines of some records of a trajectory file
+
+    Parameters:
+        path : trajectory file name
+        offsets : byte offsets of the lines (offset field of the records)
+
+    Returns:
+        list with the text lines (new line character included)
+    """
+    lines = []
+    with open_file(path, "rb") as fin:
+        for offset in offsets:
+            fin.seek(int(offset))
+            lines.append(fin.readline().decode())
+    return lines
+
+
+def cache_path(path, suffix=CACHE_SUFFIX):
+    """
+    Name of the binary cache (or frame index) of a trajectory file
+
+    Parameters:
+        path : trajectory file name
+        suffix : CACHE_SUFFIX or INDEX_SUFFIX
+
+    Returns:
+        name of the .npy file with the data and of the .json file with its metadata
+    """
+    return path + suffix + ".npy", path + suffix + ".json"
+
+
+def is_cache_file(path):
+    """
+    True if path is a cache or an index file written next to a trajectory
+    """
+    name = os.path.basename(path)
+    return CACHE_SUFFIX in name or INDEX_SUFFIX in name
+
+
+def _source_signature(path, run_column, n_header):
+    """
+    Metadata used to decide if the cache of a trajectory file is still valid
+    """
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+            "run_column": run_column, "n_header": n_header}
+
+
+def write_cache(path, records, run_column=True, n_header=HEADER_LINES):
+    """
+    Writes the records of a trajectory file in the binary cache next to it.
+
+    Coordinates are stored in float32 when all the values are read back the same
+    after rounding to 3 decimals (see coordinates), otherwise records are stored
+    as they are.
+
+    Parameters:
+        path : trajectory file name
+        records : records array returned by read_trajectory
+        run_column : True if the first column is the run number
+        n_header : number of header lines skipped
+
+    Returns:
+        name of the cache file
+    """
+    values_max = max([np.nanmax(np.abs(records[field]), initial=0) for field in ("t", "r1", "r2")])
+    if values_max < FLOAT32_MAX_VALUE:
+        single = records.astype(CACHE_DTYPE)
+        # round trip check: values with more than 3 decimals are not kept by float32
+        if all(np.array_equal(coordinates(single, field), records[field], equal_nan=True) for field in ("t", "r1", "r2")):
+            records = single
+
+    return _write_sidecar(path, CACHE_SUFFIX, records, run_column, n_header)
+
+
+def _write_sidecar(path, suffix, array, run_column, n_header):
+    """
+    Saves an array next to a trajectory file together with the file signature
+    """
+    npy_file, json_file = cache_path(path, suffix)
+    signature = _source_signature(path, run_column, n_header)
+
+    # write to temporary files first so that a killed job never leaves a broken cache
+    with open(npy_file + ".tmp", "wb") as fout:
+        np.save(fout, array)
+    with open(json_file + ".tmp", "w") as fout:
+        json.dump(signature, fout)
+    os.replace(npy_file + ".tmp", npy_file)
+    os.replace(json_file + ".tmp", json_file)
+    return npy_file
+
+
+def _load_sidecar(path, suffix, run_column, n_header):
+    """
+    Memory maps an array saved next to a trajectory file, None if the
+    trajectory file changed since it was written
+    """
+    npy_file, json_file = cache_path(path, suffix)
+    try:
+        with open(json_file, "r") as fin:
+            signature = json.load(fin)
+        if signature != _source_signature(path, run_column, n_header):
+            return None
+        return np.load(npy_file, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+
+
+def load_cache(path, run_column=True, n_header=HEADER_LINES):
+    """
+    Memory maps the binary cache of a trajectory file
+
+    Parameters:
+        path : trajectory file name
+        run_column : True if the first column is the run number
+        n_header : number of header lines skipped
+
+    Returns:
+        records array (memory mapped) or None if there is no valid cache,
+        i.e. the trajectory file changed size or modification time
+    """
+    return _load_sidecar(path, CACHE_SUFFIX, run_column, n_header)
+
+
+def load_trajectory(path, run_column=True, n_header=HEADER_LINES, use_cache=True):
+    """
+    Reads an sda trajectory file through its binary cache.
+
+    The first time the file is parsed and the records are saved next to it
+    (trajectories_N.sdacache.npy). Later calls memory map the cache as long as
+    the size and the modification time of the trajectory file are unchanged.
+
+    Parameters:
+        path : trajectory file name
+        run_column : True if the first column is the run number
+        n_header : number of header lines to skip
+        use_cache : if False, always parse the text file and do not write any cache
+
+    Returns:
+        numpy structured array with one record per line (see TRAJ_DTYPE)
+    """
+    if not use_cache:
+        return read_trajectory(path, run_column=run_column, n_header=n_header)
+
+    records = load_cache(path, run_column=run_column, n_header=n_header)
+    if records is not None:
+        return records
+
+    records = read_trajectory(path, run_column=run_column, n_header=n_header)
+    try:
+        write_cache(path, records, run_column=run_column, n_header=n_header)
+    except OSError:
+        # read only folder, work without cache
+        return records
+    return load_cache(path, run_column=run_column, n_header=n_header)
+
+
+def frame_starts(records):
+    """
+    Index of the first record of each frame (a new frame starts when run or frame changes)
+
+    Parameters:
+        records : records array
+
+    Returns:
+        numpy array with the index of the first record of each frame
+    """
+    if len(records) == 0:
+        return np.zeros(0, dtype=np.int64)
+    new_frame = (np.diff(records["run"]) != 0) | (np.diff(records["frame"]) != 0)
+    return np.concatenate(([0], np.flatnonzero(new_frame) + 1))
+
+
+def previous_row(records, solute):
+    """
+    Index of the last record of a given solute at or before each record, e.g. the
+    p1 record of the frame a p2 record belongs to
+
+    Parameters:
+        records : records array
+        solute : solute index
+
+    Returns:
+        numpy array with one index per record (-1 if there is no previous record of that solute)
+    """
+    rows = np.where(records["solute"] == solute, np.arange(len(records)), -1)
+    return np.maximum.accumulate(rows) if len(rows) else rows
+
+
+def _text_blocks(path, n_header, chunk_size):
+    """
+    Reads the lines of a trajectory text file chunk_size bytes at a time
+
+    Returns:
+        generator of (text, offset) with blocks of whole lines and their byte offset
+    """
+    with open_file(path, "rb") as fin:
+        for _ in range(n_header):
+            fin.readline()
+        offset = fin.tell()
+        rest = b""
+        while True:
+            data = fin.read(chunk_size)
+            if not data:
+                break
+            data = rest + data
+            cut = data.rfind(b"\n") + 1
+            rest = data[cut:]
+            if cut > 0:
+                yield data[:cut], offset
+                offset += cut
+        if rest.strip():
+            yield rest, offset
+
+
+def _text_chunks(path, run_column, n_header, chunk_size):
+    """
+    Parses a trajectory text file chunk_size bytes at a time
+
+    Returns:
+        generator of records arrays, chunks are cut at the end of a line
+    """
+    for data, offset in _text_blocks(path, n_header, chunk_size):
+        yield parse_lines(data, run_column=run_column, offset=offset)
+
+
+def _cache_chunks(records, chunk_size):
+    """
+    Slices a (memory mapped) records array in chunks of about chunk_size bytes
+    """
+    n_records = max(1, chunk_size // records.itemsize)
+    for start in range(0, len(records), n_records):
+        yield records[start:start + n_records]
+
+
+def iter_chunks(path, run_column=True, n_header=HEADER_LINES, chunk_size=None, use_cache=True):
+    """
+    Reads a trajectory file in chunks made of whole frames.
+
+    Every chunk contains all the solutes of the frames it holds, so that a frame
+    is never split between two chunks. Memory usage is bounded by chunk_size
+    instead of the size of the trajectory file.
+
+    Parameters:
+        path : trajectory file name
+        run_column : True if the first column is the run number
+        n_header : number of header lines to skip
+        chunk_size : approximate size in bytes of a chunk. If None the whole file
+                     is returned as a single chunk (see load_trajectory)
+        use_cache : read from the binary cache if it is valid. When streaming the
+                    text file no cache is written
+
+    Returns:
+        generator of records arrays
+    """
+    if chunk_size is None:
+        yield load_trajectory(path, run_column=run_column, n_header=n_header, use_cache=use_cache)
+        return
+
+    cached = load_cache(path, run_column=run_column, n_header=n_header) if use_cache else None
+    if cached is not None:
+        chunks = _cache_chunks(cached, chunk_size)
+    else:
+        chunks = _text_chunks(path, run_column, n_header, chunk_size)
+
+    # keep the last (maybe incomplete) frame of a chunk for the next one
+    rest = None
+    for chunk in chunks:
+        if rest is not None and len(rest):
+            chunk = np.concatenate((rest, chunk))
+        starts = frame_starts(chunk)
+        if len(starts) == 0:
+            continue
+        last = starts[-1]
+        if last > 0:
+            yield chunk[:last]
+        rest = chunk[last:]
+    if rest is not None and len(rest):
+        yield rest
+
+
+def iter_frames(path, run_column=True, n_header=HEADER_LINES, chunk_size=None, use_cache=True):
+    """
+    Reads a trajectory file one frame at a time
+
+    Parameters:
+        see iter_chunks
+
+    Returns:
+        generator of records arrays, each one with all the solutes of a frame
+    """
+    for chunk in iter_chunks(path, run_column=run_column, n_header=n_header,
+                             chunk_size=chunk_size, use_cache=use_cache):
+        starts = frame_starts(chunk)
+        ends = np.append(starts[1:], len(chunk))
+        for start, end in zip(starts, ends):
+            yield chunk[start:end]
+
+
+def build_index(path, run_column=True, n_header=HEADER_LINES, chunk_size=DEFAULT_CHUNK_SIZE, use_cache=True):
+    """
+    Scans a trajectory file and records where every frame block starts.
+
+    Parameters:
+        path : trajectory file name
+        run_column : True if the first column is the run number
+        n_header : number of header lines to skip
+        chunk_size : size in bytes of the chunks read while scanning the file
+        use_cache : take the offsets from the binary cache if it is valid
+
+    Returns:
+        numpy structured array with dtype INDEX_DTYPE, one entry per frame block
+    """
+    blocks = []
+    row = 0
+    for chunk in iter_chunks(path, run_column=run_column, n_header=n_header,
+                             chunk_size=chunk_size, use_cache=use_cache):
+        starts = frame_starts(chunk)
+        ends = np.append(starts[1:], len(chunk))
+        block = np.zeros(len(starts), dtype=INDEX_DTYPE)
+        block["run"] = chunk["run"][starts]
+        block["frame"] = chunk["frame"][starts]
+        block["start"] = chunk["offset"][starts]
+        block["row"] = row + starts
+        block["n_rows"] = ends - starts
+        row += len(chunk)
+        blocks.append(block)
+
+    if not blocks:
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    index = np.concatenate(blocks)
+    # a block ends where the next one starts, the last one at the end of the file
+    index["end"][:-1] = index["start"][1:]
+    index["end"][-1] = -1
+    return index
+
+
+def load_index(path, run_column=True, n_header=HEADER_LINES, chunk_size=DEFAULT_CHUNK_SIZE, use_cache=True):
+    """
+    Frame index of a trajectory file.
+
+    The index is saved next to the trajectory (trajectories_N.sdaindex.npy) and
+    rebuilt when the trajectory file changes size or modification time.
+
+    Parameters:
+        see build_index
+
+    Returns:
+        numpy structured array with dtype INDEX_DTYPE, one entry per frame block
+    """
+    index = _load_sidecar(path, INDEX_SUFFIX, run_column, n_header)
+    if index is not None:
+        return index
+
+    index = build_index(path, run_column=run_column, n_header=n_header,
+                        chunk_size=chunk_size, use_cache=use_cache)
+    try:
+        _write_sidecar(path, INDEX_SUFFIX, index, run_column, n_header)
+    except OSError:
+        pass
+    return index
+
+
+def _merge_ranges(starts, ends):
+    """
+    Merges consecutive [start, end) ranges which touch each other
+
+    Returns:
+        two arrays with the start and the end of the merged ranges
+    """
+    if len(starts) == 0:
+        return starts, ends
+    new_range = np.concatenate(([True], starts[1:] != ends[:-1]))
+    last = np.append(np.flatnonzero(new_range)[1:] - 1, len(starts) - 1)
+    return starts[new_range], ends[last]
+
+
+def select_frames(index, runs=None, first_frame=None, last_frame=None, stride=1):
+    """
+    Selects entries of a frame index
+
+    Parameters:
+        index : frame index (see load_index)
+        runs : list of run numbers to keep, all if None
+        first_frame, last_frame : keep only frames in [first_frame, last_frame]
+        stride : keep one frame every stride frames of each run
+
+    Returns:
+        the selected entries of the index
+    """
+    mask = np.ones(len(index), dtype=bool)
+    if runs is not None:
+        mask &= np.isin(index["run"], np.asarray(list(runs), dtype=np.int64))
+    if first_frame is not None:
+        mask &= index["frame"] >= first_frame
+    if last_frame is not None:
+        mask &= index["frame"] <= last_frame
+    selected = index[mask]
+
+    if stride > 1 and len(selected):
+        # position of every frame inside its run
+        new_run = np.concatenate(([True], selected["run"][1:] != selected["run"][:-1]))
+        run_start = np.flatnonzero(new_run)
+        run_length = np.diff(np.append(run_start, len(selected)))
+        rank = np.arange(len(selected)) - np.repeat(run_start, run_length)
+        selected = selected[rank % stride == 0]
+    return selected
+
+
+def read_frames(path, runs=None, first_frame=None, last_frame=None, stride=1,
+                run_column=True, n_header=HEADER_LINES, use_cache=True, index=None):
+    """
+    Reads only some frames of a trajectory file, using the frame index to seek
+    directly to their bytes (or rows of the binary cache).
+
+    Parameters:
+        path : trajectory file name
+        runs : list of run numbers to read, all if None
+        first_frame, last_frame : read only frames in [first_frame, last_frame]
+        stride : read one frame every stride frames of each run
+        run_column : True if the first column is the run number
+        n_header : number of header lines to skip
+        use_cache : read from the binary cache if it is valid
+        index : frame index, loaded (or built) with load_index if None
+
+    Returns:
+        numpy structured array with one record per line of the selected frames
+    """
+    if index is None:
+        index = load_index(path, run_column=run_column, n_header=n_header, use_cache=use_cache)
+    blocks = select_frames(index, runs=runs, first_frame=first_frame, last_frame=last_frame, stride=stride)
+
+    cached = load_cache(path, run_column=run_column, n_header=n_header) if use_cache else None
+    chunks = []
+    if cached is not None:
+        starts, ends = _merge_ranges(blocks["row"], blocks["row"] + blocks["n_rows"])
+        for start, end in zip(starts, ends):
+            chunks.append(np.asarray(cached[start:end]))
+    else:
+        starts, ends = _merge_ranges(blocks["start"], blocks["end"])
+        with open_file(path, "rb") as fin:
+            for start, end in zip(starts, ends):
+                fin.seek(int(start))
+                data = fin.read() if end < 0 else fin.read(int(end - start))
+                chunks.append(parse_lines(data, run_column=run_column, offset=int(start)))
+
+    if not chunks:
+        return np.zeros(0, dtype=TRAJ_DTYPE)
+    return np.concatenate(chunks)
+
+
+def _record_lines(text, offset, offsets):
+    """
+    Text lines of some records of a block of lines
+
+    Parameters:
+        text : bytes read from the byte offset of the file
+        offsets : byte offsets of the lines (offset field of the records)
+
+    Returns:
+        list with the text lines (new line character included), as read_lines
+    """
+    buffer = np.frombuffer(text, dtype=np.uint8)
+    line_ends = np.flatnonzero(buffer == ord("\n")) + 1
+    if len(buffer) and buffer[-1] != ord("\n"):
+        line_ends = np.append(line_ends, len(buffer))
+    starts = np.asarray(offsets, dtype=np.int64) - offset
+    ends = line_ends[np.searchsorted(line_ends, starts, side="right")]
+    return [text[start:end].decode() for start, end in zip(starts.tolist(), ends.tolist())]
+
+
+def _group_runs(records, lines):
+    """
+    Splits the records (and their lines) of consecutive runs
+
+    Returns:
+        list of (run, records, lines)
+    """
+    if len(records) == 0:
+        return []
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(records["run"])) + 1)).tolist()
+    ends = starts[1:] + [len(records)]
+    return [(int(records["run"][start]), records[start:end], lines[start:end]) for start, end in zip(starts, ends)]
+
+
+def _stream_runs(path, runs, run_column, n_header, chunk_size):
+    """
+    Reads some runs of a (compressed) trajectory file in a single pass
+
+    Returns:
+        generator of (run, records, lines), see iter_runs
+    """
+    wanted = np.asarray(sorted(runs), dtype=np.int64)
+    pending = {}
+    for text, offset in _text_blocks(path, n_header, chunk_size):
+        records = parse_lines(text, run_column=run_column, offset=offset)
+        records = records[np.isin(records["run"], wanted)]
+        for run, run_records, run_lines in _group_runs(records, _record_lines(text, offset, records["offset"])):
+            pending.setdefault(run, ([], []))
+            pending[run][0].append(run_records)
+            pending[run][1].extend(run_lines)
+        # a run is complete once the lines of a following run are read
+        last = int(records["run"][-1]) if len(records) else None
+        for run in [run for run in pending if run != last]:
+            run_records, run_lines = pending.pop(run)
+            yield run, np.concatenate(run_records), run_lines
+    for run, (run_records, run_lines) in pending.items():
+        yield run, np.concatenate(run_records), run_lines
+
+
+def iter_runs(path, runs, run_column=True, n_header=HEADER_LINES, index=None, chunk_size=DEFAULT_CHUNK_SIZE, use_cache=True):
+    """
+    Reads some runs of a trajectory file, with the text line of every record, in the
+    order of the file.
+
+    A plain file is read through a single file handle, seeking forward from one run to
+    the next with the frame index. Every seek in a compressed file decompresses it again
+    from the start, so a compressed file is decompressed once instead, chunk_size bytes
+    at a time, keeping only the lines of the requested runs.
+
+    Parameters:
+        path : trajectory file name
+        runs : run numbers to read
+        run_column : True if the first column is the run number
+        n_header : number of header lines to skip
+        index : frame index of a plain file, loaded (or built) with load_index if None
+        chunk_size : size in bytes of the chunks read while scanning the file
+        use_cache : see load_index
+
+    Returns:
+        generator of (run, records, lines) with the records of a whole run and their text
+        lines (new line character included, as read_lines)
+    """
+    runs = {int(run) for run in runs}
+    if _decoder(path) is not None:
+        yield from _stream_runs(path, runs, run_column, n_header, chunk_size)
+        return
+
+    if index is None:
+        index = load_index(path, run_column=run_column, n_header=n_header, chunk_size=chunk_size, use_cache=use_cache)
+    blocks = select_frames(index, runs=runs)
+    if len(blocks) == 0:
+        return
+    # frame blocks grouped by run, the runs in the order of the file
+    blocks = blocks[np.lexsort((blocks["start"], blocks["run"]))]
+    bounds = np.flatnonzero(np.diff(blocks["run"])) + 1
+    groups = sorted(np.split(blocks, bounds), key=lambda group: group["start"][0])
+
+    with open(path, "rb") as fin:
+        for group in groups:
+            chunks = []
+            lines = []
+            for start, end in zip(*_merge_ranges(group["start"], group["end"])):
+                fin.seek(int(start))
+                text = fin.read() if end < 0 else fin.read(int(end - start))
+                records = parse_lines(text, run_column=run_column, offset=int(start))
+                chunks.append(records)
+                lines.extend(_record_lines(text, int(start), records["offset"]))
+            yield int(group["run"][0]), np.concatenate(chunks), lines